@@ -1,8 +1,14 @@
+import asyncio
 import logging
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import NamedTuple
 import telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, Defaults, AIORateLimiter
 from dotenv import load_dotenv
 
 # --- Load environment variables ---
@@ -13,16 +19,136 @@ import sheets_handler
 
 # --- Get configuration from environment ---
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # e.g. https://<app>.herokuapp.com; unset = polling
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # optional; Telegram sends it back with every webhook request
+# The bot only handles commands and button presses, so Telegram needn't deliver anything else
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+SHEETS_WORKER_THREADS = sheets_handler.SHEETS_HTTP_POOL_SIZE  # threads for blocking Google Sheets calls made via asyncio.to_thread
 
 # --- Basic Logging Setup ---
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=os.getenv('LOG_LEVEL', 'INFO').upper()
 )
+# httpx logs every request at INFO, which with long polling is one line per idle getUpdates
+logging.getLogger('httpx').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
+# --- Static Keyboards ---
+# Menus that never change are built once at import and reused by every handler
+class StaticInlineKeyboardMarkup(InlineKeyboardMarkup):
+    """Inline keyboard that is serialized once and reuses that dict for every request."""
+    __slots__ = ('_serialized',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        with self._unfrozen():
+            self._serialized = super().to_dict()
+
+    def to_dict(self, recursive: bool = True) -> dict:
+        return self._serialized if recursive else super().to_dict(recursive=False)
+
+
+MAIN_MENU_MARKUP = StaticInlineKeyboardMarkup([
+    [InlineKeyboardButton("Выбор по автору", callback_data='select_author')],
+    [InlineKeyboardButton("Выбор по продукту", callback_data='select_product')],
+    [InlineKeyboardButton("🎰 Лотерея", callback_data='lottery')],
+    [InlineKeyboardButton("Корзина", callback_data='view_cart')],
+    [InlineKeyboardButton("Итоги", callback_data='view_totals')],
+])
+
+PRODUCT_TYPE_MARKUP = StaticInlineKeyboardMarkup([
+    [InlineKeyboardButton("📚 Книги", callback_data='product_type_Книги')],
+    [InlineKeyboardButton("🛍 Мерч", callback_data='product_type_Мерч')],
+    [InlineKeyboardButton("⬅️ Назад", callback_data='back_to_main')]
+])
+
+EMPTY_CART_MARKUP = StaticInlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Добавить книги", callback_data='select_author')]
+])
+
+CLEARED_CART_MARKUP = StaticInlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Добавить книги", callback_data='select_author')],
+    [InlineKeyboardButton("🏠 Главное меню", callback_data='back_to_main')]
+])
+
+ADDED_TO_CART_MARKUP = StaticInlineKeyboardMarkup([
+    [InlineKeyboardButton("🛒 Корзина", callback_data='view_cart')],
+    [InlineKeyboardButton("➕ Добавить еще", callback_data='select_author')],
+    [InlineKeyboardButton("🏠 Главное меню", callback_data='back_to_main')]
+])
+
+CONFIRM_CASHLESS_MARKUP = StaticInlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Подтвердить оплату", callback_data='confirm_cashless')],
+    [InlineKeyboardButton("⬅️ Назад к корзине", callback_data='view_cart')]
+])
+
+CONFIRM_CASH_MARKUP = StaticInlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Подтвердить оплату", callback_data='confirm_cash')],
+    [InlineKeyboardButton("⬅️ Назад к корзине", callback_data='view_cart')]
+])
+
+SALE_COMPLETE_MARKUP = StaticInlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Новая продажа", callback_data='select_author')],
+    [InlineKeyboardButton("🏠 Главное меню", callback_data='back_to_main')]
+])
+
+CART_PENDING_MARKUP = StaticInlineKeyboardMarkup([
+    [InlineKeyboardButton("🛒 Вернуться к корзине", callback_data='view_cart')],
+    [InlineKeyboardButton("🏠 Главное меню", callback_data='back_to_main')]
+])
+
+BACK_TO_PRODUCT_TYPES_MARKUP = StaticInlineKeyboardMarkup([[InlineKeyboardButton("⬅️ К типам продуктов", callback_data='select_product')]])
+
+BACK_TO_AUTHORS_MARKUP = StaticInlineKeyboardMarkup([[InlineKeyboardButton("⬅️ К авторам", callback_data='select_author')]])
+
+BACK_TO_PERIODS_MARKUP = StaticInlineKeyboardMarkup([[InlineKeyboardButton("⬅️ К выбору периода", callback_data='view_totals')]])
+
+BACK_TO_MAIN_MARKUP = StaticInlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data='back_to_main')]])
+
+BACK_TO_LOTTERY_AUTHORS_MARKUP = StaticInlineKeyboardMarkup([[InlineKeyboardButton("⬅️ К авторам лотереи", callback_data='lottery')]])
+
+# Fixed rows appended to keyboards whose other buttons depend on the cart or author
+BACK_TO_CART_ROW = (InlineKeyboardButton("⬅️ Назад к корзине", callback_data='view_cart'),)
+CART_ACTION_ROWS = (
+    (InlineKeyboardButton("🗑 Очистить корзину", callback_data='clear_cart'),),
+    (InlineKeyboardButton("➕ Добавить еще", callback_data='select_author'),),
+)
+
+
+@lru_cache(maxsize=1)
+def _totals_period_markup(today) -> StaticInlineKeyboardMarkup:
+    """Builds the totals period keyboard for the given day; only the latest day is kept."""
+    def period_button(text, start):
+        return [InlineKeyboardButton(text, callback_data=f'totals_date_{start.strftime("%Y-%m-%d")}')]
+
+    return StaticInlineKeyboardMarkup([
+        period_button("📅 Сегодня", today),
+        period_button("📅 Вчера", today - timedelta(days=1)),
+        period_button("📅 За неделю", today - timedelta(days=7)),
+        period_button("📅 За месяц", today - timedelta(days=30)),
+        [InlineKeyboardButton("📅 Все время", callback_data='totals_date_all')],
+        [InlineKeyboardButton("⬅️ Назад", callback_data='back_to_main')]
+    ])
+
+
+def get_totals_period_markup() -> StaticInlineKeyboardMarkup:
+    """Returns the totals period keyboard, rebuilt only when the date changes."""
+    return _totals_period_markup(datetime.now().date())
+
+
 # --- Helper Functions ---
+# Telegram's error when editing the text of a message that has none (e.g. a photo)
+NO_TEXT_TO_EDIT_ERROR = "no text in the message to edit"
+# Telegram's error when answering a callback query that has already expired
+STALE_QUERY_ERROR = "query is too old"
+# Telegram's error when an edit would leave the message unchanged
+NOT_MODIFIED_ERROR = "message is not modified"
+# Telegram's errors when the message can no longer be edited at all
+UNEDITABLE_MESSAGE_ERRORS = ("message can't be edited", "message to edit not found")
+
+
 def safe_message_text(text: str, max_length: int = 4000) -> str:
     """Ensures message text doesn't exceed Telegram's limits."""
     if len(text) <= max_length:
@@ -32,63 +158,243 @@ def safe_message_text(text: str, max_length: int = 4000) -> str:
     return truncated + "\n\n... (сообщение обрезано из-за длины)"
 
 
+# Cart line templates shared by the cart and payment views
+CART_LINE_LOTTERY = "{marker} 🎰 Лотерея: {title} - {price} руб."
+CART_LINE_DISCOUNT = "{marker} {title} - {price} руб. (скидка {discount} руб.)"
+CART_LINE_PROMO = "{marker} {title} - {price} руб. → БЕСПЛАТНО ({reason})"
+CART_LINE_PLAIN = "{marker} {title} - {price} руб."
+
+@lru_cache(maxsize=4096)
+def format_cart_line(item, marker: str, promo_reason: str = None) -> str:
+    """Formats one cart item line; items are immutable, so each distinct line is only formatted once."""
+    fields = {'marker': marker, 'title': item.title, 'price': item.price}
+    if item.is_lottery:
+        return CART_LINE_LOTTERY.format_map(fields)
+    if item.discount_applied > 0:
+        return CART_LINE_DISCOUNT.format_map(dict(fields, discount=int(item.discount_applied)))
+    if promo_reason:
+        return CART_LINE_PROMO.format_map(dict(fields, reason=promo_reason))
+    return CART_LINE_PLAIN.format_map(fields)
+
+def render_cart_lines(products: list, numbered: bool = True, bullet: str = "•", promo_discount_map: dict = None) -> list:
+    """Formats one summary line per cart item, numbered or bulleted."""
+    promo_reasons = {product_id: info['reason'] for product_id, info in (promo_discount_map or {}).items()}
+    return [
+        format_cart_line(product, f"{i}." if numbered else bullet, promo_reasons.get(product.product_id))
+        for i, product in enumerate(products, 1)
+    ]
+
+# Sheets fetches currently running, by key, so concurrent identical requests share one call
+_inflight = {}
+
+async def coalesced(key, make_awaitable):
+    """Awaits make_awaitable(), or joins the identical call already in flight under the same key."""
+    future = _inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(make_awaitable())
+        _inflight[key] = future
+        future.add_done_callback(lambda _: _inflight.pop(key, None))
+    # Shielded so one caller being cancelled doesn't cancel the fetch for the others
+    return await asyncio.shield(future)
+
+async def warm_all_sheet_caches() -> None:
+    """Reloads products, authors and transactions in a worker thread, batching the reads when the caches are empty."""
+    await coalesced('warm_all', lambda: asyncio.to_thread(sheets_handler.warm_caches))
+
+async def warm_sheet_caches() -> None:
+    """Refreshes the product and author caches in parallel worker threads."""
+    await asyncio.gather(
+        coalesced('warm_products', lambda: asyncio.to_thread(sheets_handler.warm_product_caches)),
+        coalesced('warm_authors', lambda: asyncio.to_thread(sheets_handler.warm_author_caches))
+    )
+
+async def edit_message_photo(query, context, photo_url: str, caption: str, reply_markup=None) -> None:
+    """Shows a photo with a Markdown caption, editing only the caption if the message already shows that photo."""
+    shown_photo = (query.message.message_id, photo_url)
+    if query.message.photo and context.user_data.get('last_photo') == shown_photo:
+        if query.message.reply_markup == reply_markup and current_message_caption(query.message) == caption:
+            # Same photo, caption and buttons: nothing to send
+            return
+        try:
+            await query.edit_message_caption(caption=caption, reply_markup=reply_markup)
+        except telegram.error.BadRequest as e:
+            if NOT_MODIFIED_ERROR not in e.message.lower():
+                raise
+        return
+    await query.edit_message_media(
+        media=telegram.InputMediaPhoto(media=photo_url, caption=caption),
+        reply_markup=reply_markup
+    )
+    context.user_data['last_photo'] = shown_photo
+
+async def show_photo_or_text(query, context, photo_url: str, text: str, reply_markup=None, fallback_text: str = None) -> None:
+    """Shows a Markdown text with its photo if there is one, falling back to text only if the photo can't be shown.
+
+    fallback_text, if given, replaces text when a photo was expected but couldn't be shown.
+    """
+    if photo_url:
+        try:
+            await edit_message_photo(query, context, photo_url, text, reply_markup)
+            return
+        except Exception as e:
+            logger.error("Error showing photo %s: %s", photo_url, e)
+            text = fallback_text or text
+    await safe_edit_message_text(query, text, reply_markup=reply_markup, parse_mode='Markdown')
+
+class CartEntry(NamedTuple):
+    """Compact cart line stored in user_data; the rest of the product is looked up when rendering."""
+    product_id: object
+    author_id: object
+    price: float
+    discount: float = 0
+    is_lottery: bool = False
+    quantity: int = 1
+
+def make_cart_entry(product: dict, price=None, discount=0, is_lottery: bool = False) -> CartEntry:
+    """Builds the compact cart entry stored in user_data for a product."""
+    return CartEntry(product.get('ProductID'), product.get('AuthorID'),
+                     product.get('Price', 0) if price is None else price, discount, is_lottery)
+
+# Hard cap on items per cart so a stuck or scripted client can't grow user_data without bound
+MAX_CART_ITEMS = 500
+CART_FULL_TEXT = f"🛒 В корзине уже {MAX_CART_ITEMS} товаров. Оформите или очистите корзину, чтобы добавить ещё."
+
+def add_cart_entry(context, entry: CartEntry) -> bool:
+    """Adds an entry to the user's cart, bumping the quantity of an identical entry if present.
+
+    Returns False without changing the cart if it would exceed MAX_CART_ITEMS.
+    """
+    cart = context.user_data.setdefault('cart', [])
+    if sum(existing.quantity for existing in cart) + entry.quantity > MAX_CART_ITEMS:
+        return False
+    for i, existing in enumerate(cart):
+        if existing._replace(quantity=entry.quantity) == entry:
+            cart[i] = existing._replace(quantity=existing.quantity + entry.quantity)
+            return True
+    cart.append(entry)
+    return True
+
+async def show_added_to_cart(query, text: str) -> None:
+    """Confirms an addition with a single edit, keeping a product photo and changing only its caption."""
+    if query.message and query.message.photo:
+        try:
+            await query.edit_message_caption(caption=safe_message_text(text, 1024), reply_markup=ADDED_TO_CART_MARKUP, parse_mode=None)
+            return
+        except telegram.error.BadRequest as e:
+            if NOT_MODIFIED_ERROR in e.message.lower():
+                # Same confirmation already shown (e.g. a double tap): nothing to replace
+                return
+            logger.warning("Could not edit photo caption, sending text instead: %s", e)
+    await safe_edit_message_text(query, text, reply_markup=ADDED_TO_CART_MARKUP)
+
+async def reply_cart_full(query) -> None:
+    """Tells the user the cart is at MAX_CART_ITEMS and points them to it."""
+    await safe_edit_message_text(query, CART_FULL_TEXT, reply_markup=CART_PENDING_MARKUP)
+
+class CartItem(NamedTuple):
+    """One unit in the cart as the cart, payment and confirmation views see it."""
+    product_id: int
+    author_id: int
+    title: str
+    price: float
+    promotion: str = ''
+    discount_applied: float = 0
+    is_lottery: bool = False
+
+def get_cart_products(context, author_id=None) -> list:
+    """Returns one CartItem per unit in the cart, built from the entry and the current catalog row.
+
+    With author_id, only that author's entries are turned into items.
+    """
+    product_index = sheets_handler.get_product_index()
+    cart_products = []
+    for entry in context.user_data.get('cart', []):
+        if author_id is not None and entry.author_id != author_id:
+            continue
+        catalog_product = product_index.get(entry.product_id, {})
+        # Plain items follow the current catalog price; the stored price is kept for overrides
+        # (discount, lottery) and as a fallback if the product has left the sheet
+        price = entry.price
+        if not entry.discount and not entry.is_lottery:
+            price = catalog_product.get('Price', entry.price)
+        item = CartItem(entry.product_id, entry.author_id, catalog_product.get('Title', 'Без названия'), price,
+                        catalog_product.get('Promotion', ''), entry.discount, entry.is_lottery)
+        # Items are immutable, so repeated units can share one tuple
+        cart_products.extend([item] * entry.quantity)
+    return cart_products
+
+def current_message_text(message, parse_mode=None):
+    """Returns the message's text in the given parse mode's markup, or None if it can't be reconstructed."""
+    if not message.text:
+        return None
+    if not parse_mode:
+        return message.text
+    try:
+        return message.text_markdown
+    except ValueError:
+        return None
+
+
+def current_message_caption(message):
+    """Returns the message's caption as Markdown, or None if it has none or it can't be reconstructed."""
+    if not message.caption:
+        return None
+    try:
+        return message.caption_markdown
+    except ValueError:
+        return None
+
+
+async def send_replacement_message(query, message_kwargs: dict) -> None:
+    """Sends the screen as a new message: a reply, or straight to the chat if replying fails."""
+    try:
+        await query.message.reply_text(**message_kwargs)
+    except Exception as reply_error:
+        # If reply fails, try sending to chat directly
+        logger.error("Reply failed, sending to chat: %s", reply_error)
+        await query.message.chat.send_message(**message_kwargs)
+
 async def safe_edit_message_text(query, text: str, reply_markup=None, parse_mode=None):
     """Safely edit message text with comprehensive error handling for all message types."""
     safe_text = safe_message_text(text)
+    message = query.message
+    if message and message.reply_markup == reply_markup and current_message_text(message, parse_mode) == safe_text:
+        # Re-tapping a button: skip the edit Telegram would reject as "message is not modified"
+        return
+    # The same text, keyboard and parse mode go into the edit and into any replacement message
+    message_kwargs = {'text': safe_text, 'reply_markup': reply_markup, 'parse_mode': parse_mode}
     try:
-        await query.edit_message_text(
-            text=safe_text,
-            reply_markup=reply_markup,
-            parse_mode=parse_mode
-        )
+        await query.edit_message_text(**message_kwargs)
     except telegram.error.BadRequest as e:
-        error_msg = str(e).lower()
-        if ("no text in the message to edit" in error_msg or 
-            "message can't be edited" in error_msg or
-            "message to edit not found" in error_msg or
-            "bad request" in error_msg):
+        error_msg = e.message.lower()
+        if NOT_MODIFIED_ERROR in error_msg:
+            # Content is identical; the callback query has already been answered
+            return
+        elif NO_TEXT_TO_EDIT_ERROR in error_msg:
+            # Photo messages (book covers, QR codes) can't be turned into text: replace them
             try:
-                # For media messages or other non-text messages, send a new message
-                await query.message.reply_text(
-                    text=safe_text,
-                    reply_markup=reply_markup,
-                    parse_mode=parse_mode
-                )
-            except Exception as reply_error:
-                # If reply fails, try sending to chat directly
-                logger.error(f"Reply failed, sending to chat: {reply_error}")
-                await query.message.chat.send_message(
-                    text=safe_text,
-                    reply_markup=reply_markup,
-                    parse_mode=parse_mode
-                )
-        elif "message is not modified" in error_msg:
-            await query.answer()
+                await query.message.delete()
+            except telegram.error.BadRequest as delete_error:
+                # Too old or no rights to delete: the new message still goes out below the photo
+                logger.warning("Could not delete photo message: %s", delete_error)
+            await send_replacement_message(query, message_kwargs)
+        elif any(error in error_msg for error in UNEDITABLE_MESSAGE_ERRORS) or "bad request" in error_msg:
+            # For messages that can no longer be edited, send a new message
+            await send_replacement_message(query, message_kwargs)
         else:
-            logger.error(f"Unexpected error editing message: {e}")
+            logger.error("Unexpected error editing message: %s", e)
             # Fallback: send new message
             try:
-                await query.message.reply_text(
-                    text=safe_text,
-                    reply_markup=reply_markup,
-                    parse_mode=parse_mode
-                )
+                await query.message.reply_text(**message_kwargs)
             except Exception as fallback_error:
-                logger.error(f"Fallback message failed: {fallback_error}")
+                logger.error("Fallback message failed: %s", fallback_error)
                 await query.answer("❌ Произошла ошибка при обновлении сообщения")
 
 
 # --- Command Handlers ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends a welcome message when the /start command is issued."""
-    keyboard = [
-        [InlineKeyboardButton("Выбор по автору", callback_data='select_author')],
-        [InlineKeyboardButton("Выбор по продукту", callback_data='select_product')],
-        [InlineKeyboardButton("🎰 Лотерея", callback_data='lottery')],
-        [InlineKeyboardButton("Корзина", callback_data='view_cart')],
-        [InlineKeyboardButton("Итоги", callback_data='view_totals')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = MAIN_MENU_MARKUP
 
     await update.message.reply_text(
         'Добро пожаловать в кассу книжной ярмарки! Выберите действие:',
@@ -98,130 +404,71 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def refresh(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Clears all caches and forces fresh data from Google Sheets."""
-    sheets_handler.clear_all_caches()
+    # Off the event loop: clearing waits on the transaction ID lock, which a sale holds while it reads the sheet
+    await asyncio.to_thread(sheets_handler.clear_all_caches)
     await update.message.reply_text('🔄 Кэш очищен! Данные будут обновлены при следующем обращении к Google Таблицам.')
+    # Reload in a worker thread now, so the next click isn't the one waiting on the Sheets API
+    await warm_all_sheet_caches()
 
 
 # --- Callback Query Handler ---
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles callback queries from inline keyboards."""
     query = update.callback_query
-    await query.answer()
-    
-    if query.data == 'select_author':
-        await show_authors(query, context)
-    elif query.data == 'select_product':
-        await show_product_types(query, context)
-    elif query.data == 'lottery':
-        await show_lottery_authors(query, context)
-    elif query.data.startswith('product_type_'):
-        product_type = query.data.split('_')[2]
-        await show_products_by_type(query, context, product_type)
-    elif query.data.startswith('author_') and not query.data.startswith('author_payment_') and not query.data.startswith('author_details_'):
-        author_id = int(query.data.split('_')[1])
-        await show_products_by_author(query, context, author_id)
-    elif query.data.startswith('product_'):
-        product_id = int(query.data.split('_')[1])
-        await show_product_details(query, context, product_id)
-    elif query.data.startswith('add_to_cart_discount_'):
-        product_id = int(query.data.split('_')[4])
-        await add_to_cart(query, context, product_id, with_discount=True)
-    elif query.data.startswith('add_to_cart_'):
-        product_id = int(query.data.split('_')[3])
-        await add_to_cart(query, context, product_id)
-    elif query.data == 'view_cart':
-        await show_cart(query, context)
-    elif query.data == 'view_totals':
-        await show_totals(query, context)
-    elif query.data.startswith('totals_date_'):
-        date = query.data.split('_')[2]
-        await show_sales_summary(query, context, date)
-    elif query.data.startswith('author_details_'):
-        parts = query.data.split('_')
-        author_id = int(parts[2])
-        date = parts[3] if len(parts) > 3 else None
-        await show_author_details(query, context, author_id, date)
-    elif query.data == 'payment_cashless':
-        await handle_cashless_payment(query, context)
-    elif query.data == 'payment_cash':
-        await handle_cash_payment(query, context)
-    elif query.data.startswith('author_payment_') and not query.data.startswith('author_payment_cashless_') and not query.data.startswith('author_payment_cash_'):
-        author_id = int(query.data.split('_')[2])
-        await show_author_payment_options(query, context, author_id)
-    elif query.data.startswith('author_payment_cashless_'):
-        author_id = int(query.data.split('_')[3])
-        await handle_author_cashless_payment(query, context, author_id)
-    elif query.data.startswith('author_payment_cash_'):
-        author_id = int(query.data.split('_')[3])
-        await handle_author_cash_payment(query, context, author_id)
-    elif query.data == 'clear_cart':
-        await clear_cart(query, context)
-    elif query.data == 'confirm_cashless':
-        await confirm_payment(query, context, 'cashless')
-    elif query.data == 'confirm_cash':
-        await confirm_payment(query, context, 'cash')
-    elif query.data.startswith('confirm_author_cashless_'):
-        author_id = int(query.data.split('_')[3])
-        await confirm_author_payment(query, context, author_id, 'cashless')
-    elif query.data.startswith('confirm_author_cash_'):
-        author_id = int(query.data.split('_')[3])
-        await confirm_author_payment(query, context, author_id, 'cash')
-    elif query.data == 'back_to_main':
-        await handle_back_to_main(query, context)
-    elif query.data.startswith('products_page_'):
-        parts = query.data.split('_')
-        product_type = parts[2]
-        page = int(parts[3])
-        await show_products_by_type(query, context, product_type, page)
-    elif query.data.startswith('lottery_author_'):
-        author_id = int(query.data.split('_')[2])
-        await show_lottery_products_by_author(query, context, author_id)
-    elif query.data.startswith('lottery_product_'):
-        product_id = int(query.data.split('_')[2])
-        await show_lottery_product_details(query, context, product_id)
-    elif query.data.startswith('add_lottery_'):
-        product_id = int(query.data.split('_')[2])
-        await add_lottery_to_cart(query, context, product_id)
+    # Refresh any expired sheet caches in a worker thread while the answer is in flight to Telegram
+    try:
+        await asyncio.gather(query.answer(), warm_sheet_caches())
+    except telegram.error.BadRequest as e:
+        # The user stopped waiting for this click long ago (we're backlogged); skip the work and its edits
+        if STALE_QUERY_ERROR in e.message.lower():
+            logger.info("Skipping expired callback query: %s", query.data)
+            return
+        raise
+    
+    route = CALLBACK_ROUTES.get(query.data)
+    if route:
+        handler, args = route
+        await handler(query, context, *args)
+        return
+    
+    match = CALLBACK_PREFIX_RE.match(query.data)
+    if not match:
+        logger.warning("Unknown callback data: %r", query.data)
+        return
+    
+    handler, parse_args = CALLBACK_PREFIX_HANDLERS[match.group(1)]
+    try:
+        args = parse_args(match.group(2))
+    except ValueError:
+        # Stale or hand-crafted callback_data: drop it here rather than fail inside the handler
+        logger.warning("Malformed callback data: %r", query.data)
+        return
+    await handler(query, context, *args)
 
 
 async def show_product_types(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Shows product type selection (Мерч/Книги)."""
-    keyboard = [
-        [InlineKeyboardButton("📚 Книги", callback_data='product_type_Книги')],
-        [InlineKeyboardButton("🛍 Мерч", callback_data='product_type_Мерч')],
-        [InlineKeyboardButton("⬅️ Назад", callback_data='back_to_main')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await safe_edit_message_text(query, 'Выберите тип продукта:', reply_markup=reply_markup)
+    await safe_edit_message_text(query, 'Выберите тип продукта:', reply_markup=PRODUCT_TYPE_MARKUP)
 
 
-async def show_products_by_type(query, context: ContextTypes.DEFAULT_TYPE, product_type: str, page: int = 0) -> None:
-    """Shows products by selected type with pagination."""
-    # Get all products of the specific type
-    all_products = sheets_handler.get_all_products()
-    products = [p for p in all_products if p.get('ProductType', '').strip() == product_type]
-    
-    if not products:
-        keyboard = [[InlineKeyboardButton("⬅️ К типам продуктов", callback_data='select_product')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await safe_edit_message_text(query, f"Продукты типа '{product_type}' не найдены.", reply_markup=reply_markup)
-        return
-    
-    # Pagination settings
-    items_per_page = 10
-    start_idx = page * items_per_page
-    end_idx = start_idx + items_per_page
-    page_products = products[start_idx:end_idx]
+# Pagination settings
+PRODUCTS_PER_PAGE = 10
+
+# (product_type, page) -> (product list it was built from, markup); stale once the product groups refresh
+_product_page_markups = {}
+
+def product_page_markup(product_type: str, page: int, products: list) -> StaticInlineKeyboardMarkup:
+    """Returns the keyboard for one page of a product type, built once per product list refresh."""
+    cached = _product_page_markups.get((product_type, page))
+    if cached and cached[0] is products:
+        return cached[1]
     
-    keyboard = []
-    for product in page_products:
-        product_title = product.get('Title', 'Без названия')
-        product_id = product.get('ProductID')
-        # Truncate title if too long for button
-        if len(product_title) > 30:
-            product_title = product_title[:27] + "..."
-        keyboard.append([InlineKeyboardButton(product_title, callback_data=f'product_{product_id}')])
+    start_idx = page * PRODUCTS_PER_PAGE
+    end_idx = start_idx + PRODUCTS_PER_PAGE
+    keyboard = [
+        [InlineKeyboardButton(product['DisplayTitle'], callback_data=f"product_{product.get('ProductID')}")]
+        for product in products[start_idx:end_idx]
+    ]
     
     # Add pagination buttons if needed
     pagination_row = []
@@ -234,19 +481,55 @@ async def show_products_by_type(query, context: ContextTypes.DEFAULT_TYPE, produ
         keyboard.append(pagination_row)
     
     # Add back button
-    keyboard.append([InlineKeyboardButton("⬅️ К типам продуктов", callback_data='select_product')])
+    keyboard.append(BACK_TO_PRODUCT_TYPES_MARKUP.inline_keyboard[0])
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    markup = StaticInlineKeyboardMarkup(keyboard)
+    _product_page_markups[(product_type, page)] = (products, markup)
+    return markup
+
+
+async def show_products_by_type(query, context: ContextTypes.DEFAULT_TYPE, product_type: str, page: int = 0) -> None:
+    """Shows products by selected type with pagination."""
+    products = sheets_handler.get_products_by_type(product_type)
+    total_products = len(products)
+    
+    if not total_products:
+        reply_markup = BACK_TO_PRODUCT_TYPES_MARKUP
+        await safe_edit_message_text(query, f"Продукты типа '{product_type}' не найдены.", reply_markup=reply_markup)
+        return
+    
+    reply_markup = product_page_markup(product_type, page, products)
     
     # Create message text with pagination info
-    total_products = len(products)
-    showing_from = start_idx + 1
-    showing_to = min(end_idx, total_products)
+    showing_from = page * PRODUCTS_PER_PAGE + 1
+    showing_to = min((page + 1) * PRODUCTS_PER_PAGE, total_products)
     message_text = f"📦 {product_type} ({showing_from}-{showing_to} из {total_products})\n\nВыберите продукт:"
     
     await safe_edit_message_text(query, message_text, reply_markup=reply_markup)
 
 
+# callback_data prefix -> (author list it was built from, markup); stale once the author list refreshes
+_author_list_markups = {}
+
+def author_list_markup(authors: list, callback_prefix: str) -> StaticInlineKeyboardMarkup:
+    """Returns a keyboard with one button per author and a back row, built once per author list refresh."""
+    cached = _author_list_markups.get(callback_prefix)
+    if cached and cached[0] is authors:
+        return cached[1]
+    
+    keyboard = [
+        [InlineKeyboardButton(author.get('Name', 'Неизвестный автор'), callback_data=f"{callback_prefix}{author.get('AuthorID')}")]
+        for author in authors
+    ]
+    
+    # Add back button
+    keyboard.append(BACK_TO_MAIN_MARKUP.inline_keyboard[0])
+    
+    markup = StaticInlineKeyboardMarkup(keyboard)
+    _author_list_markups[callback_prefix] = (authors, markup)
+    return markup
+
+
 async def show_authors(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Shows a list of authors as inline keyboard buttons."""
     authors = sheets_handler.get_authors()
@@ -255,16 +538,7 @@ async def show_authors(query, context: ContextTypes.DEFAULT_TYPE) -> None:
         await safe_edit_message_text(query, "Извините, не удалось загрузить список авторов.")
         return
     
-    keyboard = []
-    for author in authors:
-        author_name = author.get('Name', 'Неизвестный автор')
-        author_id = author.get('AuthorID')
-        keyboard.append([InlineKeyboardButton(author_name, callback_data=f'author_{author_id}')])
-    
-    # Add back button
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data='back_to_main')])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = author_list_markup(authors, 'author_')
     
     await safe_edit_message_text(query, 'Выберите автора:', reply_markup=reply_markup)
 
@@ -274,41 +548,33 @@ async def show_products_by_author(query, context: ContextTypes.DEFAULT_TYPE, aut
     products = sheets_handler.get_products_by_author(author_id)
     
     if not products:
-        keyboard = [[InlineKeyboardButton("⬅️ К авторам", callback_data='select_author')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = BACK_TO_AUTHORS_MARKUP
         await safe_edit_message_text(query, "У этого автора пока нет доступных книг.", reply_markup=reply_markup)
         return
     
-    keyboard = []
-    for product in products:
-        product_title = product.get('Title', 'Без названия')
-        product_id = product.get('ProductID')
-        keyboard.append([InlineKeyboardButton(product_title, callback_data=f'product_{product_id}')])
+    keyboard = [
+        [InlineKeyboardButton(product.get('Title', 'Без названия'), callback_data=f"product_{product.get('ProductID')}")]
+        for product in products
+    ]
     
     # Add back button
-    keyboard.append([InlineKeyboardButton("⬅️ К авторам", callback_data='select_author')])
+    keyboard.append(BACK_TO_AUTHORS_MARKUP.inline_keyboard[0])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await safe_edit_message_text(query, 'Выберите книгу:', reply_markup=reply_markup)
 
 
+# Product and lottery detail screens (Markdown)
+PRODUCT_DETAILS_TEMPLATE = "📚 *{title}*\n\n👤 Автор: {author_name}\n💰 Цена: {price} руб.{promotion_text}\n\n📝 {description}"
+PROMOTION_3FOR2_TEXT = "\n🎉 *Участвует в акции «3 за 2»!*"
+LOTTERY_PRICE = 200  # Every lottery prize costs the same
+LOTTERY_DETAILS_TEMPLATE = "🎰 *Лотерея: {title}*\n\n👤 Автор: {author_name}\n💰 Цена лотереи: {price} руб.\n\n📝 {description}"
+
+
 async def show_product_details(query, context: ContextTypes.DEFAULT_TYPE, product_id: int) -> None:
     """Shows product details with photo and add to cart button."""
-    # Get all products to find the specific one
-    authors = sheets_handler.get_authors()
-    all_products = []
-    
-    for author in authors:
-        author_id = author.get('AuthorID')
-        products = sheets_handler.get_products_by_author(author_id)
-        all_products.extend(products)
-    
-    product = None
-    for p in all_products:
-        if p.get('ProductID') == product_id:
-            product = p
-            break
+    product = sheets_handler.get_product_by_id(product_id)
     
     if not product:
         await safe_edit_message_text(query, "Книга не найдена.")
@@ -322,19 +588,15 @@ async def show_product_details(query, context: ContextTypes.DEFAULT_TYPE, produc
     discount = product.get('Discount', 0)
     
     # Find author name
-    author_name = 'Неизвестный автор'
-    for author in authors:
-        if author.get('AuthorID') == author_id:
-            author_name = author.get('Name', 'Неизвестный автор')
-            break
+    author = sheets_handler.get_author_by_id(author_id)
+    author_name = author.get('Name', 'Неизвестный автор') if author else 'Неизвестный автор'
     
     # Check if product is part of the "3 for 2" promotion
-    promotion_text = ""
-    promotion_type = product.get('Promotion', '').strip().lower()
-    if promotion_type == '3for2':
-        promotion_text = "\n🎉 *Участвует в акции «3 за 2»!*"
+    promotion_text = PROMOTION_3FOR2_TEXT if product.get('Promotion') == '3for2' else ""
     
-    message_text = f"📚 *{title}*\n\n👤 Автор: {author_name}\n💰 Цена: {price} руб.{promotion_text}\n\n📝 {description}"
+    message_text = PRODUCT_DETAILS_TEMPLATE.format(
+        title=title, author_name=author_name, price=price, promotion_text=promotion_text, description=description
+    )
     
     keyboard = [
         [InlineKeyboardButton("🛒 Добавить в корзину", callback_data=f'add_to_cart_{product_id}')],
@@ -348,29 +610,12 @@ async def show_product_details(query, context: ContextTypes.DEFAULT_TYPE, produc
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    try:
-        if photo_url:
-            await query.edit_message_media(
-                media=telegram.InputMediaPhoto(media=photo_url, caption=message_text, parse_mode='Markdown'),
-                reply_markup=reply_markup
-            )
-        else:
-            await query.edit_message_text(text=message_text, parse_mode='Markdown', reply_markup=reply_markup)
-    except Exception as e:
-        logger.error(f"Error sending product details: {e}")
-        await query.edit_message_text(text=message_text, parse_mode='Markdown', reply_markup=reply_markup)
+    await show_photo_or_text(query, context, photo_url, message_text, reply_markup)
 
 
 async def show_lottery_product_details(query, context: ContextTypes.DEFAULT_TYPE, product_id: int) -> None:
     """Shows lottery product details with photo and add to lottery cart button."""
-    # Get all products to find the specific one
-    all_products = sheets_handler.get_all_products()
-    
-    product = None
-    for p in all_products:
-        if p.get('ProductID') == product_id:
-            product = p
-            break
+    product = sheets_handler.get_product_by_id(product_id)
     
     if not product:
         await safe_edit_message_text(query, "Товар не найден.")
@@ -382,14 +627,10 @@ async def show_lottery_product_details(query, context: ContextTypes.DEFAULT_TYPE
     author_id = product.get('AuthorID')
     
     # Find author name
-    authors = sheets_handler.get_authors()
-    author_name = 'Неизвестный автор'
-    for author in authors:
-        if author.get('AuthorID') == author_id:
-            author_name = author.get('Name', 'Неизвестный автор')
-            break
+    author = sheets_handler.get_author_by_id(author_id)
+    author_name = author.get('Name', 'Неизвестный автор') if author else 'Неизвестный автор'
     
-    message_text = f"🎰 *Лотерея: {title}*\n\n👤 Автор: {author_name}\n💰 Цена лотереи: 200 руб.\n\n📝 {description}"
+    message_text = LOTTERY_DETAILS_TEMPLATE.format(title=title, author_name=author_name, price=LOTTERY_PRICE, description=description)
     
     keyboard = [
         [InlineKeyboardButton("🛒 Добавить в корзину", callback_data=f'add_lottery_{product_id}')],
@@ -398,174 +639,100 @@ async def show_lottery_product_details(query, context: ContextTypes.DEFAULT_TYPE
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    try:
-        if photo_url:
-            await query.edit_message_media(
-                media=telegram.InputMediaPhoto(media=photo_url, caption=message_text, parse_mode='Markdown'),
-                reply_markup=reply_markup
-            )
-        else:
-            await query.edit_message_text(text=message_text, parse_mode='Markdown', reply_markup=reply_markup)
-    except Exception as e:
-        logger.error(f"Error sending lottery product details: {e}")
-        await query.edit_message_text(text=message_text, parse_mode='Markdown', reply_markup=reply_markup)
+    await show_photo_or_text(query, context, photo_url, message_text, reply_markup)
 
 
 async def add_to_cart(query, context: ContextTypes.DEFAULT_TYPE, product_id: int, with_discount: bool = False) -> None:
     """Adds a product to the user's cart."""
-    if 'cart' not in context.user_data:
-        context.user_data['cart'] = []
-    
     # Find the product details
-    authors = sheets_handler.get_authors()
-    all_products = []
-    
-    for author in authors:
-        author_id = author.get('AuthorID')
-        products = sheets_handler.get_products_by_author(author_id)
-        all_products.extend(products)
-    
-    product = None
-    for p in all_products:
-        if p.get('ProductID') == product_id:
-            product = p
-            break
+    product = sheets_handler.get_product_by_id(product_id)
     
     if product:
-        # Create a copy of the product to modify if discount is applied
-        cart_product = product.copy()
+        # Store a compact cart entry; the rest of the product is looked up when rendering
+        cart_product = make_cart_entry(product)
         
-        if with_discount:
-            discount = product.get('Discount', 0)
-            if discount and discount > 0:
-                original_price = product.get('Price', 0)
-                discounted_price = max(0, original_price - discount)
-                cart_product['Price'] = discounted_price
-                cart_product['DiscountApplied'] = discount
+        discount = product.get('Discount', 0) if with_discount else 0
+        if discount > 0:
+            discounted_price = max(0, product.get('Price', 0) - discount)
+            cart_product = make_cart_entry(product, price=discounted_price, discount=discount)
         
-        context.user_data['cart'].append(cart_product)
+        if not add_cart_entry(context, cart_product):
+            await reply_cart_full(query)
+            return
         title = product.get('Title', 'Без названия')
         
-        if with_discount and product.get('Discount', 0) > 0:
-            discount_amount = product.get('Discount', 0)
-            await query.answer(f"✅ '{title}' добавлена в корзину со скидкой {int(discount_amount)} руб.!")
+        # The query is already answered, so the confirmation goes into the message itself
+        if discount > 0:
+            added_text = f"✅ '{title}' добавлена в корзину со скидкой {int(discount)} руб.!"
         else:
-            await query.answer(f"✅ '{title}' добавлена в корзину!")
+            added_text = f"✅ '{title}' добавлена в корзину!"
         
-        # Show updated options
-        keyboard = [
-            [InlineKeyboardButton("🛒 Корзина", callback_data='view_cart')],
-            [InlineKeyboardButton("➕ Добавить еще", callback_data='select_author')],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data='back_to_main')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Try to edit message text, if it fails (media message), send new message
-        try:
-            await query.edit_message_text(
-                f"✅ '{title}' добавлена в корзину!\n\nЧто делаем дальше?",
-                reply_markup=reply_markup
-            )
-        except telegram.error.BadRequest as e:
-            if "no text in the message to edit" in str(e).lower():
-                # Previous message was media, delete and send new text message
-                await query.message.delete()
-                await query.message.reply_text(
-                    f"✅ '{title}' добавлена в корзину!\n\nЧто делаем дальше?",
-                    reply_markup=reply_markup
-                )
-            else:
-                raise e
+        await show_added_to_cart(query, f"{added_text}\n\nЧто делаем дальше?")
     else:
         await query.answer("❌ Ошибка при добавлении в корзину")
 
 
 async def show_cart(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Shows the contents of the user's cart grouped by author."""
-    cart = context.user_data.get('cart', [])
+    cart = get_cart_products(context)
     
     if not cart:
-        keyboard = [[InlineKeyboardButton("➕ Добавить книги", callback_data='select_author')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        try:
-            await query.edit_message_text("🛒 Ваша корзина пуста", reply_markup=reply_markup)
-        except telegram.error.BadRequest as e:
-            if "no text in the message to edit" in str(e).lower():
-                await query.message.delete()
-                await query.message.reply_text("🛒 Ваша корзина пуста", reply_markup=reply_markup)
-            else:
-                logger.error(f"Error showing empty cart: {e}")
-                await query.answer("❌ Ошибка при показе корзины")
+        await safe_edit_message_text(query, "🛒 Ваша корзина пуста", reply_markup=EMPTY_CART_MARKUP)
         return
     
     # Get payment status for each author
     author_payments = context.user_data.get('author_payments', {})
     
     # Group products by author
-    authors = sheets_handler.get_authors()
-    author_map = {author.get('AuthorID'): author.get('Name', 'Неизвестный автор') for author in authors}
-    
     authors_in_cart = {}
     for product in cart:
-        author_id = product.get('AuthorID')
+        author_id = product.author_id
         if author_id not in authors_in_cart:
             authors_in_cart[author_id] = []
         authors_in_cart[author_id].append(product)
     
+    # Look up names only for the authors actually in the cart
+    author_map = {}
+    for author_id in authors_in_cart:
+        author = sheets_handler.get_author_by_id(author_id)
+        author_map[author_id] = author.get('Name', 'Неизвестный автор') if author else f'Автор #{author_id}'
+    
     message_lines = ["🛒 *Ваша корзина:*\n"]
+    author_totals = {}
     
     # Display products grouped by author
     for author_id, products in authors_in_cart.items():
-        author_name = author_map.get(author_id, f'Автор #{author_id}')
+        author_name = author_map[author_id]
         
         # Check if this author is already paid
-        is_paid = author_payments.get(str(author_id), False)
+        is_paid = author_payments.get(author_id, False)
         payment_status = "✅ ОПЛАЧЕНО" if is_paid else ""
         
         message_lines.append(f"👤 **{author_name}** {payment_status}")
         
         # Calculate totals for this author with promotions
-        author_original_total = sum(product.get('Price', 0) for product in products)
         author_final_total, author_promotion_discounts = calculate_cart_with_promotions(products)
+        author_totals[author_id] = author_final_total
         
         # Create a map of products that get promotion discounts for display
         promo_discount_map = {}
         for discount_info in author_promotion_discounts:
-            product_id = discount_info['product'].get('ProductID')
+            product_id = discount_info['product'].product_id
             promo_discount_map[product_id] = discount_info
         
-        for product in products:
-            title = product.get('Title', 'Без названия')
-            price = product.get('Price', 0)
-            product_id = product.get('ProductID')
-            
-            # Check if it's a lottery item
-            if product.get('IsLottery', False):
-                message_lines.append(f"  • 🎰 Лотерея: {title} - {price} руб.")
-            # Check for existing discount (monetary)
-            elif product.get('DiscountApplied', 0) > 0:
-                discount_amount = product.get('DiscountApplied', 0)
-                message_lines.append(f"  • {title} - {price} руб. (скидка {int(discount_amount)} руб.)")
-            # Check for promotion discount
-            elif product_id in promo_discount_map:
-                promo_info = promo_discount_map[product_id]
-                message_lines.append(f"  • {title} - {price} руб. → БЕСПЛАТНО ({promo_info['reason']})")
-            else:
-                message_lines.append(f"  • {title} - {price} руб.")
+        message_lines.extend(render_cart_lines(products, numbered=False, bullet="  •", promo_discount_map=promo_discount_map))
         
         # Show promotion savings for this author if any
-        if author_original_total != author_final_total:
-            savings = author_original_total - author_final_total
+        savings = sum(discount_info['discount_amount'] for discount_info in author_promotion_discounts)
+        if savings:
             message_lines.append(f"  🎉 Экономия по акции «3 за 2»: {savings} руб.")
         
         message_lines.append(f"  💰 Сумма: **{author_final_total} руб.**\n")
     
-    # Calculate total cart value
-    total_cart_value = sum(calculate_cart_with_promotions(products)[0] 
-                          for products in authors_in_cart.values())
-    paid_amount = sum(calculate_cart_with_promotions(products)[0] 
-                     for author_id, products in authors_in_cart.items() 
-                     if author_payments.get(str(author_id), False))
+    # Calculate total cart value from the per-author totals computed above
+    total_cart_value = sum(author_totals.values())
+    paid_amount = sum(total for author_id, total in author_totals.items()
+                     if author_payments.get(author_id, False))
     remaining_amount = total_cart_value - paid_amount
     
     if paid_amount > 0:
@@ -577,10 +744,9 @@ async def show_cart(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     keyboard = []
     
     # Add payment buttons for each unpaid author
-    for author_id, products in authors_in_cart.items():
-        if not author_payments.get(str(author_id), False):
-            author_name = author_map.get(author_id, f'Автор #{author_id}')
-            author_total = calculate_cart_with_promotions(products)[0]
+    for author_id, author_total in author_totals.items():
+        if not author_payments.get(author_id, False):
+            author_name = author_map[author_id]
             button_text = f"Оплата - {author_name} ({author_total} руб.)"
             # Truncate if too long
             if len(button_text) > 35:
@@ -588,214 +754,93 @@ async def show_cart(query, context: ContextTypes.DEFAULT_TYPE) -> None:
             keyboard.append([InlineKeyboardButton(button_text, callback_data=f'author_payment_{author_id}')])
     
     # Add other actions
-    keyboard.append([InlineKeyboardButton("🗑 Очистить корзину", callback_data='clear_cart')])
-    keyboard.append([InlineKeyboardButton("➕ Добавить еще", callback_data='select_author')])
+    keyboard.extend(CART_ACTION_ROWS)
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await safe_edit_message_text(query, '\n'.join(message_lines), reply_markup=reply_markup, parse_mode='Markdown')
 
 
+async def show_cashless_payment(query, context, author: dict, total, item_lines: list, reply_markup) -> None:
+    """Shows the cashless payment summary with the author's QR code, or their contact if there is no QR code."""
+    qr_code_url = str(author.get('QR_Code_URL', '')).strip()
+    contact = str(author.get('Contact', '')).strip()
+    author_name = author.get('Name', 'Неизвестный автор')
+    
+    # Create cart summary
+    cart_lines = [f"💳 *Безналичная оплата*\n", f"👤 Автор: {author_name}", f"💰 Сумма: {total} руб.\n", *item_lines]
+    
+    message_text = '\n'.join(cart_lines)
+    
+    # Text used without the QR code: the contact if there is one
+    if contact:
+        text_only = message_text + f"\n\n📞 Контакт для оплаты: {contact}"
+    else:
+        text_only = message_text + "\n\n❌ Нет информации для оплаты"
+    
+    if qr_code_url:
+        # Display QR code image, or the text-only version if it can't be shown
+        await show_photo_or_text(query, context, qr_code_url, message_text + "\n\n📱 Отсканируйте QR-код для оплаты", reply_markup, fallback_text=text_only)
+    else:
+        await safe_edit_message_text(query, text_only, reply_markup=reply_markup, parse_mode='Markdown')
+
+
 async def handle_cashless_payment(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles cashless payment with QR code or contact display."""
-    cart = context.user_data.get('cart', [])
+    cart = get_cart_products(context)
     
     if not cart:
         await query.answer("❌ Корзина пуста")
         return
     
     # Calculate total with promotions and get author info
-    original_total = sum(product.get('Price', 0) for product in cart)
-    total, promotion_discounts = calculate_cart_with_promotions(cart)
+    total, _ = calculate_cart_with_promotions(cart)
     
     # Get author info from first product (assuming single author per transaction)
     first_product = cart[0]
-    author_id = first_product.get('AuthorID')
+    author_id = first_product.author_id
     
     # Find author details
-    authors = sheets_handler.get_authors()
-    author = None
-    for a in authors:
-        if a.get('AuthorID') == author_id:
-            author = a
-            break
+    author = sheets_handler.get_author_by_id(author_id)
     
     if not author:
         await safe_edit_message_text(query, "❌ Ошибка: автор не найден")
         return
     
-    qr_code_url = str(author.get('QR_Code_URL', '')).strip()
-    contact = str(author.get('Contact', '')).strip()
-    author_name = author.get('Name', 'Неизвестный автор')
-    
-    # Create cart summary
-    cart_lines = [f"💳 *Безналичная оплата*\n"]
-    cart_lines.append(f"👤 Автор: {author_name}")
-    cart_lines.append(f"💰 Сумма: {total} руб.\n")
-    
-    for i, product in enumerate(cart, 1):
-        title = product.get('Title', 'Без названия')
-        price = product.get('Price', 0)
-        if product.get('IsLottery', False):
-            cart_lines.append(f"{i}. 🎰 Лотерея: {title} - {price} руб.")
-        elif product.get('DiscountApplied', 0) > 0:
-            discount_amount = product.get('DiscountApplied', 0)
-            cart_lines.append(f"{i}. {title} - {price} руб. (скидка {int(discount_amount)} руб.)")
-        else:
-            cart_lines.append(f"{i}. {title} - {price} руб.")
-    
-    message_text = '\n'.join(cart_lines)
-    
-    keyboard = [
-        [InlineKeyboardButton("✅ Подтвердить оплату", callback_data='confirm_cashless')],
-        [InlineKeyboardButton("⬅️ Назад к корзине", callback_data='view_cart')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    try:
-        if qr_code_url:
-            # Display QR code image
-            await query.edit_message_media(
-                media=telegram.InputMediaPhoto(
-                    media=qr_code_url, 
-                    caption=message_text + f"\n\n📱 Отсканируйте QR-код для оплаты",
-                    parse_mode='Markdown'
-                ),
-                reply_markup=reply_markup
-            )
-        elif contact:
-            # Display contact info only
-            try:
-                await query.edit_message_text(
-                    text=message_text + f"\n\n📞 Контакт для оплаты: {contact}",
-                    parse_mode='Markdown',
-                    reply_markup=reply_markup
-                )
-            except telegram.error.BadRequest as e:
-                if "no text in the message to edit" in str(e).lower():
-                    await query.message.delete()
-                    await query.message.reply_text(
-                        text=message_text + f"\n\n📞 Контакт для оплаты: {contact}",
-                        parse_mode='Markdown',
-                        reply_markup=reply_markup
-                    )
-                else:
-                    raise e
-        else:
-            # No payment info available
-            try:
-                await query.edit_message_text(
-                    text=message_text + "\n\n❌ Нет информации для оплаты",
-                    parse_mode='Markdown',
-                    reply_markup=reply_markup
-                )
-            except telegram.error.BadRequest as e:
-                if "no text in the message to edit" in str(e).lower():
-                    await query.message.delete()
-                    await query.message.reply_text(
-                        text=message_text + "\n\n❌ Нет информации для оплаты",
-                        parse_mode='Markdown',
-                        reply_markup=reply_markup
-                    )
-                else:
-                    raise e
-    except Exception as e:
-        logger.error(f"Error displaying cashless payment: {e}")
-        # Fallback to text only
-        fallback_text = message_text
-        if contact:
-            fallback_text += f"\n\n📞 Контакт для оплаты: {contact}"
-        else:
-            fallback_text += "\n\n❌ Нет информации для оплаты"
-        
-        try:
-            await query.edit_message_text(
-                text=fallback_text,
-                parse_mode='Markdown',
-                reply_markup=reply_markup
-            )
-        except telegram.error.BadRequest as e:
-            if "no text in the message to edit" in str(e).lower():
-                await query.message.delete()
-                await query.message.reply_text(
-                    text=fallback_text,
-                    parse_mode='Markdown',
-                    reply_markup=reply_markup
-                )
-            else:
-                raise e
+    await show_cashless_payment(query, context, author, total, render_cart_lines(cart), CONFIRM_CASHLESS_MARKUP)
 
 
 async def handle_cash_payment(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles cash payment."""
-    cart = context.user_data.get('cart', [])
+    cart = get_cart_products(context)
     
     if not cart:
         await query.answer("❌ Корзина пуста")
         return
     
-    original_total = sum(product.get('Price', 0) for product in cart)
-    total, promotion_discounts = calculate_cart_with_promotions(cart)
+    total, _ = calculate_cart_with_promotions(cart)
     
     # Create cart summary
-    cart_lines = [f"💵 *Оплата наличными*\n"]
-    cart_lines.append(f"💰 Сумма: {total} руб.\n")
-    
-    for i, product in enumerate(cart, 1):
-        title = product.get('Title', 'Без названия')
-        price = product.get('Price', 0)
-        if product.get('IsLottery', False):
-            cart_lines.append(f"{i}. 🎰 Лотерея: {title} - {price} руб.")
-        elif product.get('DiscountApplied', 0) > 0:
-            discount_amount = product.get('DiscountApplied', 0)
-            cart_lines.append(f"{i}. {title} - {price} руб. (скидка {int(discount_amount)} руб.)")
-        else:
-            cart_lines.append(f"{i}. {title} - {price} руб.")
+    cart_lines = [f"💵 *Оплата наличными*\n", f"💰 Сумма: {total} руб.\n", *render_cart_lines(cart)]
     
     message_text = '\n'.join(cart_lines)
     
-    keyboard = [
-        [InlineKeyboardButton("✅ Подтвердить оплату", callback_data='confirm_cash')],
-        [InlineKeyboardButton("⬅️ Назад к корзине", callback_data='view_cart')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = CONFIRM_CASH_MARKUP
     
-    try:
-        await query.edit_message_text(
-            text=message_text + "\n\n💵 Примите оплату наличными",
-            parse_mode='Markdown',
-            reply_markup=reply_markup
-        )
-    except telegram.error.BadRequest as e:
-        if "no text in the message to edit" in str(e).lower():
-            await query.message.delete()
-            await query.message.reply_text(
-                text=message_text + "\n\n💵 Примите оплату наличными",
-                parse_mode='Markdown',
-                reply_markup=reply_markup
-            )
-        else:
-            raise e
+    await safe_edit_message_text(query, message_text + "\n\n💵 Примите оплату наличными", reply_markup=reply_markup, parse_mode='Markdown')
 
 
 async def show_author_payment_options(query, context: ContextTypes.DEFAULT_TYPE, author_id: int) -> None:
     """Shows payment options for a specific author."""
-    cart = context.user_data.get('cart', [])
-    
     # Get products for this specific author
-    author_products = [product for product in cart if product.get('AuthorID') == author_id]
+    author_products = get_cart_products(context, author_id)
     
     if not author_products:
         await query.answer("❌ У этого автора нет товаров в корзине")
         return
     
     # Get author details
-    authors = sheets_handler.get_authors()
-    author = None
-    for a in authors:
-        if a.get('AuthorID') == author_id:
-            author = a
-            break
+    author = sheets_handler.get_author_by_id(author_id)
     
     if not author:
         await query.answer("❌ Автор не найден")
@@ -812,193 +857,62 @@ async def show_author_payment_options(query, context: ContextTypes.DEFAULT_TYPE,
     # Create a map of products that get promotion discounts for display
     promo_discount_map = {}
     for discount_info in promotion_discounts:
-        product_id = discount_info['product'].get('ProductID')
+        product_id = discount_info['product'].product_id
         promo_discount_map[product_id] = discount_info
     
-    for product in author_products:
-        title = product.get('Title', 'Без названия')
-        price = product.get('Price', 0)
-        product_id = product.get('ProductID')
-        
-        # Check if it's a lottery item
-        if product.get('IsLottery', False):
-            message_lines.append(f"• 🎰 Лотерея: {title} - {price} руб.")
-        # Check for existing discount (monetary)
-        elif product.get('DiscountApplied', 0) > 0:
-            discount_amount = product.get('DiscountApplied', 0)
-            message_lines.append(f"• {title} - {price} руб. (скидка {int(discount_amount)} руб.)")
-        # Check for promotion discount
-        elif product_id in promo_discount_map:
-            promo_info = promo_discount_map[product_id]
-            message_lines.append(f"• {title} - {price} руб. → БЕСПЛАТНО ({promo_info['reason']})")
-        else:
-            message_lines.append(f"• {title} - {price} руб.")
+    message_lines.extend(render_cart_lines(author_products, numbered=False, promo_discount_map=promo_discount_map))
     
     message_lines.append(f"\n💰 *Сумма к оплате: {total} руб.*")
     
     keyboard = [
         [InlineKeyboardButton("💳 Безнал", callback_data=f'author_payment_cashless_{author_id}'),
          InlineKeyboardButton("💵 Наличные", callback_data=f'author_payment_cash_{author_id}')],
-        [InlineKeyboardButton("⬅️ Назад к корзине", callback_data='view_cart')]
+        BACK_TO_CART_ROW
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    try:
-        await query.edit_message_text('\n'.join(message_lines), parse_mode='Markdown', reply_markup=reply_markup)
-    except telegram.error.BadRequest as e:
-        if "no text in the message to edit" in str(e).lower():
-            await query.message.delete()
-            await query.message.reply_text('\n'.join(message_lines), parse_mode='Markdown', reply_markup=reply_markup)
-        else:
-            raise e
+    await safe_edit_message_text(query, '\n'.join(message_lines), reply_markup=reply_markup, parse_mode='Markdown')
 
 
 async def handle_author_cashless_payment(query, context: ContextTypes.DEFAULT_TYPE, author_id: int) -> None:
     """Handles cashless payment for a specific author."""
-    cart = context.user_data.get('cart', [])
-    
     # Get products for this specific author
-    author_products = [product for product in cart if product.get('AuthorID') == author_id]
+    author_products = get_cart_products(context, author_id)
     
     if not author_products:
         await query.answer("❌ У этого автора нет товаров в корзине")
         return
     
     # Get author details
-    authors = sheets_handler.get_authors()
-    author = None
-    for a in authors:
-        if a.get('AuthorID') == author_id:
-            author = a
-            break
+    author = sheets_handler.get_author_by_id(author_id)
     
     if not author:
         await query.answer("❌ Автор не найден")
         return
     
-    author_name = author.get('Name', 'Неизвестный автор')
-    qr_code_url = str(author.get('QR_Code_URL', '')).strip()
-    contact = str(author.get('Contact', '')).strip()
-    
     # Calculate total for this author with promotions
-    total, promotion_discounts = calculate_cart_with_promotions(author_products)
-    
-    # Create cart summary for this author
-    cart_lines = [f"💳 *Безналичная оплата*\n"]
-    cart_lines.append(f"👤 Автор: {author_name}")
-    cart_lines.append(f"💰 Сумма: {total} руб.\n")
-    
-    for product in author_products:
-        title = product.get('Title', 'Без названия')
-        price = product.get('Price', 0)
-        if product.get('IsLottery', False):
-            cart_lines.append(f"• 🎰 Лотерея: {title} - {price} руб.")
-        elif product.get('DiscountApplied', 0) > 0:
-            discount_amount = product.get('DiscountApplied', 0)
-            cart_lines.append(f"• {title} - {price} руб. (скидка {int(discount_amount)} руб.)")
-        else:
-            cart_lines.append(f"• {title} - {price} руб.")
-    
-    message_text = '\n'.join(cart_lines)
+    total, _ = calculate_cart_with_promotions(author_products)
     
     keyboard = [
         [InlineKeyboardButton("✅ Подтвердить оплату", callback_data=f'confirm_author_cashless_{author_id}')],
-        [InlineKeyboardButton("⬅️ Назад к корзине", callback_data='view_cart')]
+        BACK_TO_CART_ROW
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    try:
-        if qr_code_url:
-            # Display QR code image
-            await query.edit_message_media(
-                media=telegram.InputMediaPhoto(
-                    media=qr_code_url, 
-                    caption=message_text + f"\n\n📱 Отсканируйте QR-код для оплаты",
-                    parse_mode='Markdown'
-                ),
-                reply_markup=reply_markup
-            )
-        elif contact:
-            # Display contact info only
-            try:
-                await query.edit_message_text(
-                    text=message_text + f"\n\n📞 Контакт для оплаты: {contact}",
-                    parse_mode='Markdown',
-                    reply_markup=reply_markup
-                )
-            except telegram.error.BadRequest as e:
-                if "no text in the message to edit" in str(e).lower():
-                    await query.message.delete()
-                    await query.message.reply_text(
-                        text=message_text + f"\n\n📞 Контакт для оплаты: {contact}",
-                        parse_mode='Markdown',
-                        reply_markup=reply_markup
-                    )
-                else:
-                    raise e
-        else:
-            # No payment info available
-            try:
-                await query.edit_message_text(
-                    text=message_text + "\n\n❌ Нет информации для оплаты",
-                    parse_mode='Markdown',
-                    reply_markup=reply_markup
-                )
-            except telegram.error.BadRequest as e:
-                if "no text in the message to edit" in str(e).lower():
-                    await query.message.delete()
-                    await query.message.reply_text(
-                        text=message_text + "\n\n❌ Нет информации для оплаты",
-                        parse_mode='Markdown',
-                        reply_markup=reply_markup
-                    )
-                else:
-                    raise e
-    except Exception as e:
-        logger.error(f"Error displaying author cashless payment: {e}")
-        # Fallback to text only
-        fallback_text = message_text
-        if contact:
-            fallback_text += f"\n\n📞 Контакт для оплаты: {contact}"
-        else:
-            fallback_text += "\n\n❌ Нет информации для оплаты"
-        
-        try:
-            await query.edit_message_text(
-                text=fallback_text,
-                parse_mode='Markdown',
-                reply_markup=reply_markup
-            )
-        except telegram.error.BadRequest as e:
-            if "no text in the message to edit" in str(e).lower():
-                await query.message.delete()
-                await query.message.reply_text(
-                    text=fallback_text,
-                    parse_mode='Markdown',
-                    reply_markup=reply_markup
-                )
-            else:
-                raise e
+    await show_cashless_payment(query, context, author, total, render_cart_lines(author_products, numbered=False), reply_markup)
 
 
 async def handle_author_cash_payment(query, context: ContextTypes.DEFAULT_TYPE, author_id: int) -> None:
     """Handles cash payment for a specific author."""
-    cart = context.user_data.get('cart', [])
-    
     # Get products for this specific author
-    author_products = [product for product in cart if product.get('AuthorID') == author_id]
+    author_products = get_cart_products(context, author_id)
     
     if not author_products:
         await query.answer("❌ У этого автора нет товаров в корзине")
         return
     
     # Get author details
-    authors = sheets_handler.get_authors()
-    author = None
-    for a in authors:
-        if a.get('AuthorID') == author_id:
-            author = a
-            break
+    author = sheets_handler.get_author_by_id(author_id)
     
     if not author:
         await query.answer("❌ Автор не найден")
@@ -1007,75 +921,50 @@ async def handle_author_cash_payment(query, context: ContextTypes.DEFAULT_TYPE,
     author_name = author.get('Name', 'Неизвестный автор')
     
     # Calculate total for this author with promotions
-    total, promotion_discounts = calculate_cart_with_promotions(author_products)
+    total, _ = calculate_cart_with_promotions(author_products)
     
     # Create cart summary for this author
-    cart_lines = [f"💵 *Оплата наличными*\n"]
-    cart_lines.append(f"👤 Автор: {author_name}")
-    cart_lines.append(f"💰 Сумма: {total} руб.\n")
-    
-    for product in author_products:
-        title = product.get('Title', 'Без названия')
-        price = product.get('Price', 0)
-        if product.get('IsLottery', False):
-            cart_lines.append(f"• 🎰 Лотерея: {title} - {price} руб.")
-        elif product.get('DiscountApplied', 0) > 0:
-            discount_amount = product.get('DiscountApplied', 0)
-            cart_lines.append(f"• {title} - {price} руб. (скидка {int(discount_amount)} руб.)")
-        else:
-            cart_lines.append(f"• {title} - {price} руб.")
+    cart_lines = [
+        f"💵 *Оплата наличными*\n", f"👤 Автор: {author_name}", f"💰 Сумма: {total} руб.\n",
+        *render_cart_lines(author_products, numbered=False)
+    ]
     
     message_text = '\n'.join(cart_lines)
     
     keyboard = [
         [InlineKeyboardButton("✅ Подтвердить оплату", callback_data=f'confirm_author_cash_{author_id}')],
-        [InlineKeyboardButton("⬅️ Назад к корзине", callback_data='view_cart')]
+        BACK_TO_CART_ROW
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    try:
-        await query.edit_message_text(
-            text=message_text + "\n\n💵 Примите оплату наличными",
-            parse_mode='Markdown',
-            reply_markup=reply_markup
-        )
-    except telegram.error.BadRequest as e:
-        if "no text in the message to edit" in str(e).lower():
-            await query.message.delete()
-            await query.message.reply_text(
-                text=message_text + "\n\n💵 Примите оплату наличными",
-                parse_mode='Markdown',
-                reply_markup=reply_markup
-            )
-        else:
-            raise e
+    await safe_edit_message_text(query, message_text + "\n\n💵 Примите оплату наличными", reply_markup=reply_markup, parse_mode='Markdown')
 
 
 def calculate_cart_with_promotions(cart):
     """Calculate cart total with '3 for the price of 2' promotion based on Google Sheets data."""
+    # Cart items are immutable tuples, so the cart's contents make a usable cache key
+    return _calculate_cart_with_promotions(tuple(cart))
+
+# Clicking through the payment screens recalculates the same cart several times
+@lru_cache(maxsize=128)
+def _calculate_cart_with_promotions(cart: tuple):
+    """Computes (total, promotion discounts) for a cart; the result is shared, so callers must not modify it."""
     if not cart:
-        return 0, []
+        return 0, ()
     
-    # Separate lottery products, promotion products, and regular products
-    lottery_products = []
+    # One pass: total the lottery products (always their fixed price) and the regular products
+    # (includes existing discount logic), and set the promotion products aside
+    lottery_total = 0
+    regular_total = 0
     promotion_products = []
-    regular_products = []
     
     for product in cart:
-        if product.get('IsLottery', False):
-            lottery_products.append(product)
+        if product.is_lottery:
+            lottery_total += product.price
+        elif product.promotion == '3for2':
+            promotion_products.append(product)
         else:
-            promotion_type = product.get('Promotion', '').strip().lower()
-            if promotion_type == '3for2':
-                promotion_products.append(product)
-            else:
-                regular_products.append(product)
-    
-    # Calculate lottery products total (always their fixed price)
-    lottery_total = sum(product.get('Price', 0) for product in lottery_products)
-    
-    # Calculate regular products total (includes existing discount logic)
-    regular_total = sum(product.get('Price', 0) for product in regular_products)
+            regular_total += product.price
     
     # Calculate promotion products with "3 for 2" logic
     promotion_total = 0
@@ -1083,20 +972,20 @@ def calculate_cart_with_promotions(cart):
     
     if promotion_products:
         # Sort promotion products by price (descending) to identify cheapest in each group of 3
-        sorted_promo = sorted(promotion_products, key=lambda p: p.get('Price', 0), reverse=True)
+        sorted_promo = sorted(promotion_products, key=lambda p: p.price, reverse=True)
         
         for i in range(0, len(sorted_promo), 3):
             group = sorted_promo[i:i+3]
             
             if len(group) == 3:
                 # Full group of 3: pay for 2, cheapest is free
-                group_prices = [p.get('Price', 0) for p in group]
+                group_prices = [p.price for p in group]
                 cheapest_price = min(group_prices)
                 group_total = sum(group_prices) - cheapest_price
                 promotion_total += group_total
                 
                 # Track which product gets the discount
-                cheapest_product = min(group, key=lambda p: p.get('Price', 0))
+                cheapest_product = group[group_prices.index(cheapest_price)]
                 promotion_discounts.append({
                     'product': cheapest_product,
                     'discount_amount': cheapest_price,
@@ -1104,10 +993,10 @@ def calculate_cart_with_promotions(cart):
                 })
             else:
                 # Incomplete group: pay full price
-                promotion_total += sum(p.get('Price', 0) for p in group)
+                promotion_total += sum(p.price for p in group)
     
     total = lottery_total + regular_total + promotion_total
-    return total, promotion_discounts
+    return total, tuple(promotion_discounts)
 
 
 async def clear_cart(query, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1115,69 +1004,45 @@ async def clear_cart(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     context.user_data['cart'] = []
     context.user_data['author_payments'] = {}
     
-    keyboard = [
-        [InlineKeyboardButton("➕ Добавить книги", callback_data='select_author')],
-        [InlineKeyboardButton("🏠 Главное меню", callback_data='back_to_main')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    try:
-        await query.edit_message_text(
-            "🗑 Корзина очищена",
-            reply_markup=reply_markup
-        )
-    except telegram.error.BadRequest as e:
-        if "no text in the message to edit" in str(e).lower():
-            await query.message.delete()
-            await query.message.reply_text(
-                "🗑 Корзина очищена",
-                reply_markup=reply_markup
-            )
-        else:
-            raise e
+    await safe_edit_message_text(query, "🗑 Корзина очищена", reply_markup=CLEARED_CART_MARKUP)
 
 
 async def confirm_payment(query, context: ContextTypes.DEFAULT_TYPE, payment_method: str) -> None:
     """Confirms payment and records transactions."""
-    cart = context.user_data.get('cart', [])
+    cart = get_cart_products(context)
     
     if not cart:
         await query.answer("❌ Корзина пуста")
         return
     
+    # Take the cart before the write: updates run concurrently, so a second tap on confirm
+    # must find it empty, and items added while the write is in flight stay in the new cart
+    context.user_data['cart'] = []
+    
     # Calculate final prices with promotions
     total_amount, promotion_discounts = calculate_cart_with_promotions(cart)
     
-    # Create a map of promotion discounts for transaction recording
-    promo_discount_map = {}
-    for discount_info in promotion_discounts:
-        product_id = discount_info['product'].get('ProductID')
-        promo_discount_map[product_id] = discount_info
-    
-    # Record each product as a separate transaction
-    successful_transactions = 0
-    failed_transactions = 0
+    # Products made free by a promotion; recording only needs to test membership
+    promo_product_ids = frozenset(discount_info['product'].product_id for discount_info in promotion_discounts)
     
+    # Record each product as a separate transaction row, written in one batch
+    transactions = []
     for product in cart:
-        product_id = product.get('ProductID')
-        author_id = product.get('AuthorID')
-        
+        product_id = product.product_id
+        author_id = product.author_id
+
         # Use promotion-adjusted price if applicable
-        if product_id in promo_discount_map:
+        if product_id in promo_product_ids:
             # Product is free due to "3 for 2" promotion
             price = 0
         else:
             # Use original price (which may already include monetary discounts)
-            price = product.get('Price', 0)
-        
-        success = sheets_handler.record_transaction(product_id, author_id, payment_method, price)
-        if success:
-            successful_transactions += 1
-        else:
-            failed_transactions += 1
-    
-    # Clear cart after recording transactions
-    context.user_data['cart'] = []
+            price = product.price
+
+        transactions.append((product_id, author_id, payment_method, price))
+
+    successful_transactions = await asyncio.to_thread(sheets_handler.record_transactions_batch, transactions)
+    failed_transactions = len(transactions) - successful_transactions
     
     # Prepare result message
     payment_emoji = "💳" if payment_method == "cashless" else "💵"
@@ -1188,48 +1053,23 @@ async def confirm_payment(query, context: ContextTypes.DEFAULT_TYPE, payment_met
     else:
         result_message = f"⚠️ Оплата завершена с ошибками!\n\n{payment_emoji} {payment_text.capitalize()}: {total_amount} руб.\n✅ Успешно: {successful_transactions}\n❌ Ошибок: {failed_transactions}"
     
-    keyboard = [
-        [InlineKeyboardButton("➕ Новая продажа", callback_data='select_author')],
-        [InlineKeyboardButton("🏠 Главное меню", callback_data='back_to_main')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = SALE_COMPLETE_MARKUP
     
     # Try to edit message text, if it fails (media message), delete and send new message
-    try:
-        await query.edit_message_text(
-            result_message,
-            reply_markup=reply_markup
-        )
-    except telegram.error.BadRequest as e:
-        if "no text in the message to edit" in str(e).lower():
-            # Previous message was media, delete and send new text message
-            await query.message.delete()
-            await query.message.reply_text(
-                result_message,
-                reply_markup=reply_markup
-            )
-        else:
-            raise e
+    await safe_edit_message_text(query, result_message, reply_markup=reply_markup)
 
 
 async def confirm_author_payment(query, context: ContextTypes.DEFAULT_TYPE, author_id: int, payment_method: str) -> None:
     """Confirms payment for a specific author and records transactions."""
-    cart = context.user_data.get('cart', [])
-    
     # Get products for this specific author
-    author_products = [product for product in cart if product.get('AuthorID') == author_id]
+    author_products = get_cart_products(context, author_id)
     
     if not author_products:
         await query.answer("❌ У этого автора нет товаров в корзине")
         return
     
     # Get author details
-    authors = sheets_handler.get_authors()
-    author = None
-    for a in authors:
-        if a.get('AuthorID') == author_id:
-            author = a
-            break
+    author = sheets_handler.get_author_by_id(author_id)
     
     if not author:
         await query.answer("❌ Автор не найден")
@@ -1237,40 +1077,37 @@ async def confirm_author_payment(query, context: ContextTypes.DEFAULT_TYPE, auth
     
     author_name = author.get('Name', 'Неизвестный автор')
     
+    # Mark this author as paid before the write, keyed by the same int AuthorID the cart entries carry:
+    # updates run concurrently, so a second tap on confirm must not record the same items again
+    author_payments = context.user_data.setdefault('author_payments', {})
+    if author_id in author_payments:
+        await query.answer("✅ Оплата этого автора уже записана")
+        return
+    author_payments[author_id] = True
+    
     # Calculate final prices with promotions for this author
     total_amount, promotion_discounts = calculate_cart_with_promotions(author_products)
     
-    # Create a map of promotion discounts for transaction recording
-    promo_discount_map = {}
-    for discount_info in promotion_discounts:
-        product_id = discount_info['product'].get('ProductID')
-        promo_discount_map[product_id] = discount_info
-    
-    # Record each product as a separate transaction
-    successful_transactions = 0
-    failed_transactions = 0
+    # Products made free by a promotion; recording only needs to test membership
+    promo_product_ids = frozenset(discount_info['product'].product_id for discount_info in promotion_discounts)
     
+    # Record each product as a separate transaction row, written in one batch
+    transactions = []
     for product in author_products:
-        product_id = product.get('ProductID')
+        product_id = product.product_id
         
         # Use promotion-adjusted price if applicable
-        if product_id in promo_discount_map:
+        if product_id in promo_product_ids:
             # Product is free due to "3 for 2" promotion
             price = 0
         else:
             # Use original price (which may already include monetary discounts)
-            price = product.get('Price', 0)
+            price = product.price
         
-        success = sheets_handler.record_transaction(product_id, author_id, payment_method, price)
-        if success:
-            successful_transactions += 1
-        else:
-            failed_transactions += 1
+        transactions.append((product_id, author_id, payment_method, price))
     
-    # Mark this author as paid
-    if 'author_payments' not in context.user_data:
-        context.user_data['author_payments'] = {}
-    context.user_data['author_payments'][str(author_id)] = True
+    successful_transactions = await asyncio.to_thread(sheets_handler.record_transactions_batch, transactions)
+    failed_transactions = len(transactions) - successful_transactions
     
     # Prepare result message
     payment_emoji = "💳" if payment_method == "cashless" else "💵"
@@ -1282,8 +1119,9 @@ async def confirm_author_payment(query, context: ContextTypes.DEFAULT_TYPE, auth
         result_message = f"⚠️ Оплата для {author_name} завершена с ошибками!\n\n{payment_emoji} {payment_text.capitalize()}: {total_amount} руб.\n✅ Успешно: {successful_transactions}\n❌ Ошибок: {failed_transactions}"
     
     # Check if all authors are paid
-    all_authors_in_cart = set(product.get('AuthorID') for product in cart)
-    paid_authors = set(int(author_id) for author_id, is_paid in context.user_data.get('author_payments', {}).items() if is_paid)
+    all_authors_in_cart = {entry.author_id for entry in context.user_data.get('cart', [])}
+    # Authors are only ever marked paid (never unmarked), so the keys are the paid set
+    paid_authors = set(context.user_data['author_payments'])
     
     if all_authors_in_cart.issubset(paid_authors):
         # All authors are paid, clear the cart and payments
@@ -1291,76 +1129,68 @@ async def confirm_author_payment(query, context: ContextTypes.DEFAULT_TYPE, auth
         context.user_data['author_payments'] = {}
         result_message += "\n\n🎉 Все авторы оплачены! Корзина очищена."
         
-        keyboard = [
-            [InlineKeyboardButton("➕ Новая продажа", callback_data='select_author')],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data='back_to_main')]
-        ]
+        reply_markup = SALE_COMPLETE_MARKUP
     else:
         # Still have unpaid authors
         remaining_authors = len(all_authors_in_cart - paid_authors)
         result_message += f"\n\n📋 Осталось оплатить авторов: {remaining_authors}"
         
-        keyboard = [
-            [InlineKeyboardButton("🛒 Вернуться к корзине", callback_data='view_cart')],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data='back_to_main')]
-        ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = CART_PENDING_MARKUP
     
     # Try to edit message text, if it fails (media message), delete and send new message
-    try:
-        await query.edit_message_text(
-            result_message,
-            reply_markup=reply_markup
-        )
-    except telegram.error.BadRequest as e:
-        if "no text in the message to edit" in str(e).lower():
-            # Previous message was media, delete and send new text message
-            await query.message.delete()
-            await query.message.reply_text(
-                result_message,
-                reply_markup=reply_markup
-            )
-        else:
-            raise e
+    await safe_edit_message_text(query, result_message, reply_markup=reply_markup)
 
 
 async def show_totals(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Shows date selection for totals view."""
-    from datetime import datetime, timedelta
-    
-    # Generate date options
-    today = datetime.now()
-    yesterday = today - timedelta(days=1)
-    week_ago = today - timedelta(days=7)
-    month_ago = today - timedelta(days=30)
+    reply_markup = get_totals_period_markup()
     
-    keyboard = [
-        [InlineKeyboardButton("📅 Сегодня", callback_data=f'totals_date_{today.strftime("%Y-%m-%d")}')],
-        [InlineKeyboardButton("📅 Вчера", callback_data=f'totals_date_{yesterday.strftime("%Y-%m-%d")}')],
-        [InlineKeyboardButton("📅 За неделю", callback_data=f'totals_date_{week_ago.strftime("%Y-%m-%d")}')],
-        [InlineKeyboardButton("📅 За месяц", callback_data=f'totals_date_{month_ago.strftime("%Y-%m-%d")}')],
-        [InlineKeyboardButton("📅 Все время", callback_data='totals_date_all')],
-        [InlineKeyboardButton("⬅️ Назад", callback_data='back_to_main')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Load the transactions while the period menu is sent, so picking a period is served from cache
+    await asyncio.gather(
+        safe_edit_message_text(query, "📊 *Итоги продаж*\n\nВыберите период для просмотра:", reply_markup=reply_markup, parse_mode='Markdown'),
+        coalesced('warm_transactions', lambda: asyncio.to_thread(sheets_handler.get_transactions_by_author))
+    )
+
+
+# 'YYYY-MM-DD' dates from callbacks and the sheet are reformatted by slicing out these groups
+ISO_DATE_RE = re.compile(r'(\d{4})-(\d{2})-(\d{2})$')
+
+def format_period(date: str) -> str:
+    """Describes a totals period: 'all' or a YYYY-MM-DD start date."""
+    if date == 'all':
+        return "за все время"
+    match = ISO_DATE_RE.match(date or '')
+    return f"с {match.group(3)}.{match.group(2)}.{match.group(1)}" if match else f"с {date}"
+
+# Summary buttons longer than this are cut with '...'
+SUMMARY_BUTTON_MAX_LENGTH = 45
+BACK_TO_PERIODS_ROW = BACK_TO_PERIODS_MARKUP.inline_keyboard[0]
+
+@lru_cache(maxsize=64)
+def back_to_summary_markup(date: str) -> StaticInlineKeyboardMarkup:
+    """Returns the 'back to the sales summary' keyboard for a period; there are only a few periods, so each is built once."""
+    return StaticInlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад к итогам", callback_data=f'totals_date_{date}' if date else 'view_totals')]])
+
+@lru_cache(maxsize=1024)
+def format_amounts(cash: int, cashless: int, total: int) -> str:
+    """Formats a sales total with its cash/cashless breakdown; amounts repeat a lot, so results are cached."""
+    if cash > 0 and cashless > 0:
+        return f"{total}₽ (💵{cash} + 💳{cashless})"
+    if cash > 0:
+        return f"{total}₽ (💵 наличные)"
+    if cashless > 0:
+        return f"{total}₽ (💳 безнал)"
+    return "0₽"
+
+def author_summary_button(author_sales: sheets_handler.AuthorSales, date: str) -> list:
+    """Builds the keyboard row linking a sales summary line to that author's details."""
+    # Whole rubles: that's all the text shows, and it keeps the format cache small
+    amounts_text = format_amounts(round(author_sales.cash), round(author_sales.cashless), round(author_sales.total))
+    button_text = f"{author_sales.name}: {amounts_text}"
+    if len(button_text) > SUMMARY_BUTTON_MAX_LENGTH:
+        button_text = button_text[:SUMMARY_BUTTON_MAX_LENGTH - 3] + "..."
     
-    try:
-        await query.edit_message_text(
-            "📊 *Итоги продаж*\n\nВыберите период для просмотра:",
-            parse_mode='Markdown',
-            reply_markup=reply_markup
-        )
-    except telegram.error.BadRequest as e:
-        if "no text in the message to edit" in str(e).lower():
-            await query.message.delete()
-            await query.message.reply_text(
-                "📊 *Итоги продаж*\n\nВыберите период для просмотра:",
-                parse_mode='Markdown',
-                reply_markup=reply_markup
-            )
-        else:
-            raise e
+    return [InlineKeyboardButton(button_text, callback_data=f"author_details_{author_sales.author_id}_{date}")]
 
 
 async def show_sales_summary(query, context: ContextTypes.DEFAULT_TYPE, date: str) -> None:
@@ -1368,63 +1198,26 @@ async def show_sales_summary(query, context: ContextTypes.DEFAULT_TYPE, date: st
     try:
         # Get sales data
         start_date = None if date == 'all' else date
-        summary = sheets_handler.get_sales_summary_by_author(start_date)
+        summary = await coalesced(('summary', start_date), lambda: asyncio.to_thread(sheets_handler.get_sales_summary_by_author, start_date))
         
         if not summary:
-            keyboard = [[InlineKeyboardButton("⬅️ К выбору периода", callback_data='view_totals')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                "📊 Нет данных о продажах за выбранный период.",
-                reply_markup=reply_markup
-            )
+            reply_markup = BACK_TO_PERIODS_MARKUP
+            await safe_edit_message_text(query, "📊 Нет данных о продажах за выбранный период.", reply_markup=reply_markup)
             return
         
         # Format date string for display
-        from datetime import datetime
-        if date == 'all':
-            period_text = "за все время"
-        else:
-            try:
-                date_obj = datetime.strptime(date, '%Y-%m-%d')
-                period_text = f"с {date_obj.strftime('%d.%m.%Y')}"
-            except:
-                period_text = f"с {date}"
+        period_text = format_period(date)
         
         message_lines = [f"📊 *Итоги продаж {period_text}*\n"]
         
-        # Calculate totals
-        total_cash = sum(author_data['cash'] for author_data in summary.values())
-        total_cashless = sum(author_data['cashless'] for author_data in summary.values())
+        # Calculate totals; rows already come sorted by total (descending)
+        total_cash = total_cashless = 0
+        for author_sales in summary:
+            total_cash += author_sales.cash
+            total_cashless += author_sales.cashless
         grand_total = total_cash + total_cashless
         
-        # Sort authors by total sales (descending)
-        sorted_authors = sorted(summary.items(), key=lambda x: x[1]['total'], reverse=True)
-        
-        keyboard = []
-        for author_name, author_data in sorted_authors:
-            cash = author_data['cash']
-            cashless = author_data['cashless']
-            total = author_data['total']
-            author_id = author_data['author_id']
-            
-            # Format amounts
-            if cash > 0 and cashless > 0:
-                amounts_text = f"{total:.0f}₽ (💵{cash:.0f} + 💳{cashless:.0f})"
-            elif cash > 0:
-                amounts_text = f"{total:.0f}₽ (💵 наличные)"
-            elif cashless > 0:
-                amounts_text = f"{total:.0f}₽ (💳 безнал)"
-            else:
-                amounts_text = "0₽"
-            
-            # Create button for author details
-            button_text = f"{author_name}: {amounts_text}"
-            # Truncate if too long
-            if len(button_text) > 45:
-                button_text = button_text[:42] + "..."
-            
-            callback_data = f'author_details_{author_id}_{date}' if date != 'all' else f'author_details_{author_id}_all'
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
+        keyboard = [author_summary_button(author_sales, date) for author_sales in summary]
         
         # Add summary at the end of message
         message_lines.append("📈 *ОБЩИЙ ИТОГ:*")
@@ -1435,83 +1228,60 @@ async def show_sales_summary(query, context: ContextTypes.DEFAULT_TYPE, date: st
         message_lines.append(f"💰 **Всего: {grand_total:.0f} руб.**")
         
         # Add back button
-        keyboard.append([InlineKeyboardButton("⬅️ К выбору периода", callback_data='view_totals')])
+        keyboard.append(BACK_TO_PERIODS_ROW)
         
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await safe_edit_message_text(query, '\n'.join(message_lines), reply_markup=reply_markup, parse_mode='Markdown')
         
     except Exception as e:
-        logger.error(f"Error showing sales summary: {e}")
-        keyboard = [[InlineKeyboardButton("⬅️ К выбору периода", callback_data='view_totals')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            "❌ Ошибка при загрузке данных.",
-            reply_markup=reply_markup
-        )
+        logger.error("Error showing sales summary: %s", e)
+        reply_markup = BACK_TO_PERIODS_MARKUP
+        await safe_edit_message_text(query, "❌ Ошибка при загрузке данных.", reply_markup=reply_markup)
+
 
+# Transactions listed on the author details screen; older ones are only counted
+AUTHOR_DETAILS_MAX_ROWS = 10
+
+def format_transaction_line(number: int, transaction: dict) -> str:
+    """Formats one author details row, showing the 'YYYY-MM-DD ...' timestamp as DD.MM."""
+    payment_emoji = "💵" if transaction['payment_method'] == 'cash' else "💳"
+    timestamp = str(transaction['timestamp'])
+    if len(timestamp) >= 10 and timestamp[4] == timestamp[7] == '-':
+        # Timestamps the bot writes start with 'YYYY-MM-DD', so slicing is enough
+        formatted_date = f"{timestamp[8:10]}.{timestamp[5:7]}"
+    else:
+        formatted_date = timestamp.split(' ')[0] or 'Неизвестно'
+    return f"{number}. {transaction['product_title']} - {payment_emoji} {transaction['amount']:.0f}₽ ({formatted_date})"
 
-async def show_author_details(query, context: ContextTypes.DEFAULT_TYPE, author_id: int, date: str = None) -> None:
-    """Shows detailed sales information for a specific author."""
+
+async def show_author_details(query, context: ContextTypes.DEFAULT_TYPE, author_id: int, date: str = None, page: int = 0) -> None:
+    """Shows detailed sales information for a specific author, AUTHOR_DETAILS_MAX_ROWS transactions per page."""
     try:
         # Get author info
-        authors = sheets_handler.get_authors()
-        author = None
-        for a in authors:
-            if a.get('AuthorID') == author_id:
-                author = a
-                break
+        author = sheets_handler.get_author_by_id(author_id)
         
         if not author:
-            await query.edit_message_text("❌ Автор не найден.")
+            await safe_edit_message_text(query, "❌ Автор не найден.")
             return
         
         author_name = author.get('Name', 'Неизвестный автор')
         start_date = None if date == 'all' else date
         
-        # Get detailed transactions
-        transactions = sheets_handler.get_author_transactions_detail(author_id, start_date)
+        # Get totals and this page of transactions, newest first
+        offset = page * AUTHOR_DETAILS_MAX_ROWS
+        detail = await coalesced(
+            ('author_details', author_id, start_date, page),
+            lambda: asyncio.to_thread(sheets_handler.get_author_transactions_detail, author_id, start_date, AUTHOR_DETAILS_MAX_ROWS, offset)
+        )
         
-        if not transactions:
-            keyboard = [[InlineKeyboardButton("⬅️ Назад к итогам", callback_data=f'totals_date_{date}')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                f"📚 *{author_name}*\n\nНет продаж за выбранный период.",
-                parse_mode='Markdown',
-                reply_markup=reply_markup
-            )
+        if not detail.count:
+            reply_markup = back_to_summary_markup(date)
+            await safe_edit_message_text(query, f"📚 *{author_name}*\n\nНет продаж за выбранный период.", reply_markup=reply_markup, parse_mode='Markdown')
             return
         
-        # Calculate totals
-        total_amount = 0
-        cash_amount = 0
-        cashless_amount = 0
-        
-        for transaction in transactions:
-            amount = transaction['amount']
-            if isinstance(amount, str):
-                try:
-                    amount = float(amount)
-                except ValueError:
-                    amount = 0
-            
-            total_amount += amount
-            payment_method = transaction['payment_method'].lower()
-            if payment_method == 'cash':
-                cash_amount += amount
-            elif payment_method == 'cashless':
-                cashless_amount += amount
-        
         # Format period text
-        if date == 'all':
-            period_text = "за все время"
-        else:
-            try:
-                from datetime import datetime
-                date_obj = datetime.strptime(date, '%Y-%m-%d')
-                period_text = f"с {date_obj.strftime('%d.%m.%Y')}"
-            except:
-                period_text = f"с {date}"
+        period_text = format_period(date)
         
         # Build message
         message_lines = [f"📚 *{author_name}*"]
@@ -1519,261 +1289,267 @@ async def show_author_details(query, context: ContextTypes.DEFAULT_TYPE, author_
         
         # Summary
         message_lines.append("💰 *Итого:*")
-        if cash_amount > 0:
-            message_lines.append(f"💵 Наличные: {cash_amount:.0f} руб.")
-        if cashless_amount > 0:
-            message_lines.append(f"💳 Безнал: {cashless_amount:.0f} руб.")
-        message_lines.append(f"**Всего: {total_amount:.0f} руб.**\n")
+        if detail.cash > 0:
+            message_lines.append(f"💵 Наличные: {detail.cash:.0f} руб.")
+        if detail.cashless > 0:
+            message_lines.append(f"💳 Безнал: {detail.cashless:.0f} руб.")
+        message_lines.append(f"**Всего: {detail.total:.0f} руб.**\n")
         
         # Transactions list
-        message_lines.append(f"📋 *Продано товаров: {len(transactions)}*")
+        message_lines.append(f"📋 *Продано товаров: {detail.count}*")
         
-        # Show up to 10 most recent transactions
-        for i, transaction in enumerate(transactions[:10]):
-            payment_emoji = "💵" if transaction['payment_method'].lower() == 'cash' else "💳"
-            timestamp = transaction['timestamp'].split(' ')[0] if transaction['timestamp'] else 'Неизвестно'
-            try:
-                from datetime import datetime
-                date_obj = datetime.strptime(timestamp, '%Y-%m-%d')
-                formatted_date = date_obj.strftime('%d.%m')
-            except:
-                formatted_date = timestamp
-            
-            amount = transaction['amount']
-            if isinstance(amount, str):
-                try:
-                    amount = float(amount)
-                except ValueError:
-                    amount = 0
-            
-            message_lines.append(f"{i+1}. {transaction['product_title']} - {payment_emoji} {amount:.0f}₽ ({formatted_date})")
+        # Show this page of transactions
+        message_lines.extend(
+            format_transaction_line(i, transaction)
+            for i, transaction in enumerate(detail.transactions, offset + 1)
+        )
         
-        if len(transactions) > 10:
-            message_lines.append(f"... и еще {len(transactions) - 10} транзакций")
+        shown_to = offset + len(detail.transactions)
+        if detail.count > shown_to:
+            message_lines.append(f"... и еще {detail.count - shown_to} транзакций")
         
-        keyboard = [[InlineKeyboardButton("⬅️ Назад к итогам", callback_data=f'totals_date_{date}')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        keyboard = []
+        
+        # Add pagination buttons if needed
+        pagination_row = []
+        if page > 0:
+            pagination_row.append(InlineKeyboardButton("⬅️ Пред.", callback_data=f'author_details_{author_id}_{date}_{page-1}'))
+        if detail.count > shown_to:
+            pagination_row.append(InlineKeyboardButton("След. ➡️", callback_data=f'author_details_{author_id}_{date}_{page+1}'))
+        
+        if pagination_row:
+            keyboard.append(pagination_row)
+        
+        if keyboard:
+            keyboard.append(back_to_summary_markup(date).inline_keyboard[0])
+            reply_markup = InlineKeyboardMarkup(keyboard)
+        else:
+            reply_markup = back_to_summary_markup(date)
         
         await safe_edit_message_text(query, '\n'.join(message_lines), reply_markup=reply_markup, parse_mode='Markdown')
         
     except Exception as e:
-        logger.error(f"Error showing author details: {e}")
-        keyboard = [[InlineKeyboardButton("⬅️ Назад к итогам", callback_data=f'totals_date_{date}' if date else 'view_totals')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            "❌ Ошибка при загрузке данных автора.",
-            reply_markup=reply_markup
-        )
+        logger.error("Error showing author details: %s", e)
+        reply_markup = back_to_summary_markup(date)
+        await safe_edit_message_text(query, "❌ Ошибка при загрузке данных автора.", reply_markup=reply_markup)
 
 
 async def handle_back_to_main(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Returns to main menu."""
-    keyboard = [
-        [InlineKeyboardButton("Выбор по автору", callback_data='select_author')],
-        [InlineKeyboardButton("Выбор по продукту", callback_data='select_product')],
-        [InlineKeyboardButton("🎰 Лотерея", callback_data='lottery')],
-        [InlineKeyboardButton("Корзина", callback_data='view_cart')],
-        [InlineKeyboardButton("Итоги", callback_data='view_totals')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    try:
-        await query.edit_message_text(
-            'Добро пожаловать в кассу книжной ярмарки! Выберите действие:',
-            reply_markup=reply_markup
-        )
-    except telegram.error.BadRequest as e:
-        if "no text in the message to edit" in str(e).lower():
-            await query.message.delete()
-            await query.message.reply_text(
-                'Добро пожаловать в кассу книжной ярмарки! Выберите действие:',
-                reply_markup=reply_markup
-            )
-        elif "message is not modified" in str(e).lower():
-            # Message content is identical, no need to edit
-            await query.answer()
-        else:
-            raise e
+    await safe_edit_message_text(query, 'Добро пожаловать в кассу книжной ярмарки! Выберите действие:', reply_markup=MAIN_MENU_MARKUP)
 
 
 async def show_lottery_authors(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Shows authors who have lottery-eligible products."""
-    # Get lottery-eligible products
-    lottery_products = sheets_handler.get_lottery_products()
-    
-    if not lottery_products:
-        keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data='back_to_main')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await safe_edit_message_text(query, "Нет товаров, доступных для лотереи.", reply_markup=reply_markup)
-        return
-    
-    # Get unique author IDs from lottery products
-    author_ids = set(product.get('AuthorID') for product in lottery_products)
-    
-    # Get author details
-    authors = sheets_handler.get_authors()
-    lottery_authors = [author for author in authors if author.get('AuthorID') in author_ids]
+    # Authors with lottery products, kept up to date alongside the product groups
+    lottery_authors = sheets_handler.get_lottery_authors()
     
     if not lottery_authors:
-        keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data='back_to_main')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await safe_edit_message_text(query, "Нет авторов с товарами для лотереи.", reply_markup=reply_markup)
+        # Only now tell "no lottery products at all" apart from "their authors aren't in the sheet"
+        if sheets_handler.get_lottery_products():
+            message_text = "Нет авторов с товарами для лотереи."
+        else:
+            message_text = "Нет товаров, доступных для лотереи."
+        await safe_edit_message_text(query, message_text, reply_markup=BACK_TO_MAIN_MARKUP)
         return
     
-    keyboard = []
-    for author in lottery_authors:
-        author_name = author.get('Name', 'Неизвестный автор')
-        author_id = author.get('AuthorID')
-        keyboard.append([InlineKeyboardButton(author_name, callback_data=f'lottery_author_{author_id}')])
-    
-    # Add back button
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data='back_to_main')])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = author_list_markup(lottery_authors, 'lottery_author_')
     
-    try:
-        await query.edit_message_text(
-            '🎰 Лотерея - выберите автора:\n\nЦена: 200 руб.',
-            reply_markup=reply_markup
-        )
-    except telegram.error.BadRequest as e:
-        error_msg = str(e).lower()
-        if "message is not modified" in error_msg:
-            # Message content is identical - ignore this error
-            logger.info("Ignoring 'message is not modified' error in show_lottery_authors")
-        elif "no text in the message to edit" in error_msg:
-            await query.message.delete()
-            await query.message.reply_text(
-                '🎰 Лотерея - выберите автора:\n\nЦена: 200 руб.',
-                reply_markup=reply_markup
-            )
-        else:
-            raise e
+    await safe_edit_message_text(query, f'🎰 Лотерея - выберите автора:\n\nЦена: {LOTTERY_PRICE} руб.', reply_markup=reply_markup)
 
 
 async def show_lottery_products_by_author(query, context: ContextTypes.DEFAULT_TYPE, author_id: int) -> None:
     """Shows lottery products for a specific author."""
-    # Get all lottery products
-    lottery_products = sheets_handler.get_lottery_products()
-    
-    # Filter products by author
-    author_lottery_products = [product for product in lottery_products if product.get('AuthorID') == author_id]
+    # Get this author's lottery products
+    author_lottery_products = sheets_handler.get_lottery_products_by_author(author_id)
     
     if not author_lottery_products:
-        keyboard = [[InlineKeyboardButton("⬅️ К авторам лотереи", callback_data='lottery')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = BACK_TO_LOTTERY_AUTHORS_MARKUP
         await safe_edit_message_text(query, "У этого автора нет товаров для лотереи.", reply_markup=reply_markup)
         return
     
     # Get author name
-    authors = sheets_handler.get_authors()
-    author_name = 'Неизвестный автор'
-    for author in authors:
-        if author.get('AuthorID') == author_id:
-            author_name = author.get('Name', 'Неизвестный автор')
-            break
+    author = sheets_handler.get_author_by_id(author_id)
+    author_name = author.get('Name', 'Неизвестный автор') if author else 'Неизвестный автор'
     
-    keyboard = []
-    for product in author_lottery_products:
-        product_title = product.get('Title', 'Без названия')
-        product_id = product.get('ProductID')
-        # Truncate title if too long for button
-        if len(product_title) > 30:
-            product_title = product_title[:27] + "..."
-        keyboard.append([InlineKeyboardButton(product_title, callback_data=f'lottery_product_{product_id}')])
+    # DisplayTitle is the title already shortened to fit a button
+    keyboard = [
+        [InlineKeyboardButton(product['DisplayTitle'], callback_data=f"lottery_product_{product.get('ProductID')}")]
+        for product in author_lottery_products
+    ]
     
     # Add back button
-    keyboard.append([InlineKeyboardButton("⬅️ К авторам лотереи", callback_data='lottery')])
+    keyboard.append(BACK_TO_LOTTERY_AUTHORS_MARKUP.inline_keyboard[0])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    try:
-        await query.edit_message_text(
-            f'🎰 Лотерея - {author_name}\n\nВыберите выигранный товар:\nЦена: 200 руб.',
-            reply_markup=reply_markup
-        )
-    except telegram.error.BadRequest as e:
-        if "no text in the message to edit" in str(e).lower():
-            await query.message.delete()
-            await query.message.reply_text(
-                f'🎰 Лотерея - {author_name}\n\nВыберите выигранный товар:\nЦена: 200 руб.',
-                reply_markup=reply_markup
-            )
-        else:
-            raise e
+    await safe_edit_message_text(query, f'🎰 Лотерея - {author_name}\n\nВыберите выигранный товар:\nЦена: {LOTTERY_PRICE} руб.', reply_markup=reply_markup)
 
 
 async def add_lottery_to_cart(query, context: ContextTypes.DEFAULT_TYPE, product_id: int) -> None:
-    """Adds a lottery product to the user's cart with fixed price of 200 rubles."""
-    if 'cart' not in context.user_data:
-        context.user_data['cart'] = []
-    
+    """Adds a lottery product to the user's cart at the fixed LOTTERY_PRICE."""
     # Find the product details
-    all_products = sheets_handler.get_all_products()
-    product = None
-    for p in all_products:
-        if p.get('ProductID') == product_id:
-            product = p
-            break
+    product = sheets_handler.get_product_by_id(product_id)
     
     if product:
-        # Create a copy of the product with lottery-specific modifications
-        lottery_product = product.copy()
-        lottery_product['Price'] = 200  # Fixed lottery price
-        lottery_product['IsLottery'] = True  # Mark as lottery item
+        # Create a compact cart entry with lottery-specific modifications
+        lottery_product = make_cart_entry(product, price=LOTTERY_PRICE, is_lottery=True)
         
-        context.user_data['cart'].append(lottery_product)
+        if not add_cart_entry(context, lottery_product):
+            await reply_cart_full(query)
+            return
         title = product.get('Title', 'Без названия')
         
-        await query.answer(f"✅ 'Лотерея: {title}' добавлена в корзину!")
-        
-        # Show updated options
-        keyboard = [
-            [InlineKeyboardButton("🛒 Корзина", callback_data='view_cart')],
-            [InlineKeyboardButton("➕ Добавить еще", callback_data='select_author')],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data='back_to_main')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        try:
-            await query.edit_message_text(
-                f"✅ 'Лотерея: {title}' добавлена в корзину!\n\nЧто делаем дальше?",
-                reply_markup=reply_markup
-            )
-        except telegram.error.BadRequest as e:
-            if "no text in the message to edit" in str(e).lower():
-                await query.message.delete()
-                await query.message.reply_text(
-                    f"✅ 'Лотерея: {title}' добавлена в корзину!\n\nЧто делаем дальше?",
-                    reply_markup=reply_markup
-                )
-            else:
-                raise e
+        await show_added_to_cart(query, f"✅ 'Лотерея: {title}' добавлена в корзину!\n\nЧто делаем дальше?")
     else:
         await query.answer("❌ Ошибка при добавлении в корзину")
 
 
+# --- Callback Routing ---
+def _parse_int(text: str) -> int:
+    """Parses a plain run of ASCII digits; int() alone would also take '1_0', ' 1' or '+1'."""
+    if not (text.isascii() and text.isdigit()):
+        raise ValueError(f"not a callback number: {text!r}")
+    return int(text)
+
+
+def _parse_id(rest: str) -> tuple:
+    """Parses a single numeric ID from the callback_data suffix."""
+    return (_parse_int(rest),)
+
+
+def _parse_products_page(rest: str) -> tuple:
+    """Parses '<product_type>_<page>' from the callback_data suffix."""
+    product_type, page = rest.rsplit('_', 1)
+    return (product_type, _parse_int(page))
+
+
+def _parse_author_details(rest: str) -> tuple:
+    """Parses '<author_id>[_<date>[_<page>]]' from the callback_data suffix."""
+    author_id, _, rest = rest.partition('_')
+    date, _, page = rest.partition('_')
+    return (_parse_int(author_id), date or None, _parse_int(page) if page else 0)
+
+
+# Callbacks without parameters: callback_data -> (handler, extra args)
+CALLBACK_ROUTES = {
+    'select_author': (show_authors, ()),
+    'select_product': (show_product_types, ()),
+    'lottery': (show_lottery_authors, ()),
+    'view_cart': (show_cart, ()),
+    'view_totals': (show_totals, ()),
+    'payment_cashless': (handle_cashless_payment, ()),
+    'payment_cash': (handle_cash_payment, ()),
+    'clear_cart': (clear_cart, ()),
+    'confirm_cashless': (confirm_payment, ('cashless',)),
+    'confirm_cash': (confirm_payment, ('cash',)),
+    'back_to_main': (handle_back_to_main, ()),
+}
+
+# Parameterised callbacks: (prefix, handler, suffix parser)
+CALLBACK_PREFIX_ROUTES = (
+    ('product_type_', show_products_by_type, lambda rest: (rest,)),
+    ('products_page_', show_products_by_type, _parse_products_page),
+    ('author_payment_cashless_', handle_author_cashless_payment, _parse_id),
+    ('author_payment_cash_', handle_author_cash_payment, _parse_id),
+    ('author_payment_', show_author_payment_options, _parse_id),
+    ('author_details_', show_author_details, _parse_author_details),
+    ('author_', show_products_by_author, _parse_id),
+    ('product_', show_product_details, _parse_id),
+    ('add_to_cart_discount_', add_to_cart, lambda rest: (_parse_int(rest), True)),
+    ('add_to_cart_', add_to_cart, _parse_id),
+    ('totals_date_', show_sales_summary, lambda rest: (rest,)),
+    ('confirm_author_cashless_', confirm_author_payment, lambda rest: (_parse_int(rest), 'cashless')),
+    ('confirm_author_cash_', confirm_author_payment, lambda rest: (_parse_int(rest), 'cash')),
+    ('lottery_author_', show_lottery_products_by_author, _parse_id),
+    ('lottery_product_', show_lottery_product_details, _parse_id),
+    ('add_lottery_', add_lottery_to_cart, _parse_id),
+)
+
+# All prefixes compiled into one alternation so a callback is matched in a single pass.
+# Longest prefixes go first so e.g. 'product_type_' is never taken as 'product_'.
+CALLBACK_PREFIX_HANDLERS = {prefix: (handler, parse_args) for prefix, handler, parse_args in CALLBACK_PREFIX_ROUTES}
+CALLBACK_PREFIX_RE = re.compile(
+    '(' + '|'.join(re.escape(prefix) for prefix in sorted(CALLBACK_PREFIX_HANDLERS, key=len, reverse=True)) + ')(.*)',
+    re.DOTALL
+)
+
+
 # --- Main Bot Logic ---
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log errors and handle common Telegram exceptions gracefully."""
-    logger.error(f"Exception while handling an update: {context.error}")
+    # Flood control that outlasted the rate limiter's own retries. The update is not replayed:
+    # it may be a payment confirmation that already reached the sheet.
+    if isinstance(context.error, telegram.error.RetryAfter):
+        logger.warning("Telegram flood control still active after retries, retry after %s", context.error.retry_after)
+        return
+    
+    # Transient network trouble: the user can simply press the button again
+    if isinstance(context.error, telegram.error.NetworkError) and not isinstance(context.error, telegram.error.BadRequest):
+        logger.warning("Network error while handling an update: %s", context.error)
+        return
     
     # Handle specific Telegram errors
     if isinstance(context.error, telegram.error.BadRequest):
-        error_msg = str(context.error).lower()
-        if "message is not modified" in error_msg:
+        error_msg = context.error.message.lower()
+        if NOT_MODIFIED_ERROR in error_msg:
             # Message content is identical to current content - ignore this error
             logger.info("Ignoring 'message is not modified' error - content is identical")
             return
-        elif "message can't be edited" in error_msg or "message to edit not found" in error_msg:
+        elif any(error in error_msg for error in UNEDITABLE_MESSAGE_ERRORS):
             logger.info("Message editing failed - message may have been deleted or is too old")
             return
+    
+    logger.error("Exception while handling an update: %s", context.error, exc_info=context.error)
+
+
+# Products expire after 5 minutes, so reload a little before that
+SHEET_CACHE_RELOAD_INTERVAL = 240
+
+async def keep_sheet_caches_warm() -> None:
+    """Reloads the product and author caches in the background so no click waits on an expired one."""
+    # Transactions aren't reloaded here: sales write through to their cache, and the rest is read on demand
+    while True:
+        await asyncio.sleep(SHEET_CACHE_RELOAD_INTERVAL)
+        try:
+            await coalesced('reload_all', lambda: asyncio.to_thread(sheets_handler.reload_caches))
+        except Exception as e:
+            logger.warning("Background reload of the sheet caches failed: %s", e)
+
+
+async def post_init(application: Application) -> None:
+    """Sizes the worker pool and warms the Google Sheets caches before the bot starts taking updates."""
+    # Sheets calls are network-bound, and callers waiting on a cache refill hold a thread,
+    # so allow more threads than asyncio's CPU-based default
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=SHEETS_WORKER_THREADS))
+    await warm_all_sheet_caches()
+    logger.info("Google Sheets caches warmed")
+    application.bot_data['cache_reload_task'] = asyncio.create_task(keep_sheet_caches_warm())
+
+
+async def post_shutdown(application: Application) -> None:
+    """Stops the background cache reload."""
+    task = application.bot_data.pop('cache_reload_task', None)
+    if task:
+        task.cancel()
 
 
 def main() -> None:
     """Start the bot."""
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # concurrent_updates lets a slow Google Sheets call for one user not hold up everyone else.
+    # The rate limiter keeps bursts under Telegram's ~30 msg/s limit and retries on RetryAfter instead of failing.
+    # Photo captions are always Markdown, so that comes from the defaults; text edits pass parse_mode explicitly.
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .defaults(Defaults(parse_mode='Markdown'))
+        .concurrent_updates(True)
+        .rate_limiter(AIORateLimiter(overall_max_rate=28, overall_time_period=1, max_retries=3))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # --- Register Handlers ---
     # Register the /start command
@@ -1789,8 +1565,21 @@ def main() -> None:
     application.add_error_handler(error_handler)
 
     # Start the Bot
-    print("Bot is running...")
-    application.run_polling()
+    # With WEBHOOK_URL set, Telegram pushes updates to us; otherwise fall back to polling.
+    if WEBHOOK_URL:
+        logger.info("Bot is running (webhook)...")
+        application.run_webhook(
+            listen='0.0.0.0',
+            port=int(os.getenv('PORT', '8443')),
+            url_path=TELEGRAM_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        logger.info("Bot is running...")
+        # Long polling: getUpdates waits up to 30s and returns as soon as an update arrives.
+        application.run_polling(timeout=30, poll_interval=0.0, bootstrap_retries=-1, allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == '__main__':
@@ -1,39 +1,107 @@
 import gspread
 import os
 import json
+import logging
+import random
 import base64
+import re
+import threading
 import time
+from datetime import datetime
 from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
-from functools import wraps
+from functools import lru_cache, wraps
+from operator import attrgetter
+from typing import NamedTuple
 
 # --- Load environment variables ---
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Sheets calls run on up to this many threads at once (see SHEETS_WORKER_THREADS in bot.py)
+SHEETS_HTTP_POOL_SIZE = 32
+SHEETS_HTTP_TIMEOUT = (10, 60)  # seconds to connect, seconds to wait for a response
+
 # --- Cache for reducing API calls ---
-_cache = {}
+_cache = {}  # key -> (result, expiry time on the monotonic clock)
+_cache_locks = {}
 CACHE_TTL = 300  # 5 minutes cache
+CACHE_MAX_ENTRIES = 1024  # beyond this the oldest entries go even if they haven't expired yet
+
+def _drop_cache_entry(cache_key):
+    """Removes a cached result together with its refill lock, unless a refill is holding that lock."""
+    _cache.pop(cache_key, None)
+    lock = _cache_locks.get(cache_key)
+    if lock is not None and not lock.locked():
+        _cache_locks.pop(cache_key, None)
+
+def _evict_expired(now):
+    """Drops cached results whose TTL has passed, so entries for one-off arguments don't pile up."""
+    for cache_key, (_, expires_at) in list(_cache.items()):
+        if expires_at <= now:
+            _drop_cache_entry(cache_key)
 
 def with_cache(ttl=CACHE_TTL):
     """Decorator to cache function results"""
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            cache_key = f"{func.__name__}_{str(args)}_{str(kwargs)}"
-            current_time = time.time()
-            
-            if cache_key in _cache:
-                cached_result, cached_time = _cache[cache_key]
-                if current_time - cached_time < ttl:
-                    return cached_result
+            # Tuple key: a plain hash probe per hit, no string formatting of the arguments
+            cache_key = (func.__name__, args, tuple(sorted(kwargs.items())) if kwargs else ())
+            try:
+                cached = _cache.get(cache_key)
+            except TypeError:
+                # Unhashable arguments (lists, dicts) can't be cached: call straight through
+                return func(*args, **kwargs)
+            if cached and time.monotonic() < cached[1]:
+                return cached[0]
             
-            result = func(*args, **kwargs)
-            _cache[cache_key] = (result, current_time)
-            return result
+            # One refill per key: concurrent callers wait for it instead of all hitting the API
+            with _cache_locks.setdefault(cache_key, threading.Lock()):
+                cached = _cache.get(cache_key)
+                if cached and time.monotonic() < cached[1]:
+                    return cached[0]
+                result = func(*args, **kwargs)
+                now = time.monotonic()
+                _evict_expired(now)
+                while len(_cache) >= CACHE_MAX_ENTRIES:
+                    # Dicts keep insertion order, so the first key is the least recently filled entry
+                    _drop_cache_entry(next(iter(_cache)))
+                _cache[cache_key] = (result, now + ttl)
+                return result
         return wrapper
     return decorator
 
-def retry_with_backoff(max_retries=3, base_delay=1):
+def refill_lock(func_name):
+    """Returns the lock with_cache holds while it refills an argument-less cached function."""
+    return _cache_locks.setdefault((func_name, (), ()), threading.Lock())
+
+def prime_cache(func_name, result, ttl=CACHE_TTL):
+    """Stores the result of an argument-less cached function as if it had just been called."""
+    _cache[(func_name, (), ())] = (result, time.monotonic() + ttl)
+
+def invalidate_cache(func_name):
+    """Drops every cached result of the given function."""
+    for cache_key in list(_cache):
+        if cache_key[0] == func_name:
+            _cache.pop(cache_key, None)
+
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})  # rate limit and transient server errors
+# A 5xx can arrive after Google has already applied a write, so writes only retry rejected (rate-limited) requests
+WRITE_RETRYABLE_STATUS_CODES = frozenset({429})
+MAX_RETRY_DELAY = 60
+
+def _retry_delay(error, attempt, base_delay):
+    """Seconds to wait before the next attempt: the server's Retry-After if given, else jittered exponential backoff."""
+    retry_after = error.response.headers.get('Retry-After', '')
+    if retry_after.isdigit():
+        return min(int(retry_after), MAX_RETRY_DELAY)
+    # Jitter keeps handlers that hit the quota together from all retrying at the same moment
+    return min(base_delay * (2 ** attempt) * random.uniform(0.8, 1.2), MAX_RETRY_DELAY)
+
+def retry_with_backoff(max_retries=3, base_delay=1, retryable=RETRYABLE_STATUS_CODES):
     """Decorator for exponential backoff retry on API errors"""
     def decorator(func):
         @wraps(func)
@@ -41,15 +109,13 @@ def retry_with_backoff(max_retries=3, base_delay=1):
             for attempt in range(max_retries):
                 try:
                     return func(*args, **kwargs)
-                except Exception as e:
-                    if "429" in str(e) or "Quota exceeded" in str(e):
-                        if attempt < max_retries - 1:
-                            delay = base_delay * (2 ** attempt)
-                            print(f"Rate limit hit, retrying in {delay} seconds...")
-                            time.sleep(delay)
-                            continue
-                    raise e
-            return func(*args, **kwargs)
+                except gspread.exceptions.APIError as e:
+                    # Other 4xx errors (bad range, no access) fail the same way on every attempt
+                    if e.response.status_code not in retryable or attempt == max_retries - 1:
+                        raise
+                    delay = _retry_delay(e, attempt, base_delay)
+                    logger.warning("Sheets API error %s, retrying in %.1f seconds...", e.response.status_code, delay)
+                    time.sleep(delay)
         return wrapper
     return decorator
 
@@ -67,251 +133,673 @@ GOOGLE_SHEET_ID = os.getenv('GOOGLE_SHEET_ID')
 
 # --- Authenticate and Connect to Google Sheets ---
 # This code supports dual authentication: Heroku (encoded) or local file
+@lru_cache(maxsize=1)  # Decoded once; every caller shares the same Credentials and its token refresh state
 def get_google_credentials():
     """Get Google credentials either from encoded string (Heroku) or local file (development)."""
     
     # Check if we have encoded credentials (for Heroku production)
     encoded_creds = os.getenv('GOOGLE_CREDS_ENCODED')
     if encoded_creds:
-        print("Using encoded Google credentials (production mode)")
+        logger.info("Using encoded Google credentials (production mode)")
         try:
             # Decode the Base64 string
             creds_json = base64.b64decode(encoded_creds).decode('utf-8')
             creds_dict = json.loads(creds_json)
             return Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
         except Exception as e:
-            print(f"ERROR: Failed to decode Google credentials: {e}")
+            logger.error("Failed to decode Google credentials: %s", e)
             return None
     
     # Fall back to local file (for development)
     elif GOOGLE_CREDENTIALS_FILE and os.path.exists(GOOGLE_CREDENTIALS_FILE):
-        print(f"Using local Google credentials file: {GOOGLE_CREDENTIALS_FILE}")
+        logger.info("Using local Google credentials file: %s", GOOGLE_CREDENTIALS_FILE)
         try:
             return Credentials.from_service_account_file(GOOGLE_CREDENTIALS_FILE, scopes=SCOPES)
         except Exception as e:
-            print(f"ERROR: Failed to load credentials from file: {e}")
+            logger.error("Failed to load credentials from file: %s", e)
             return None
     
     else:
-        print("ERROR: No Google credentials found!")
-        print("Set GOOGLE_CREDS_ENCODED environment variable or ensure credentials file exists.")
+        logger.error("No Google credentials found! Set GOOGLE_CREDS_ENCODED environment variable or ensure credentials file exists.")
         return None
 
-try:
-    creds = get_google_credentials()
-    if not creds:
-        raise Exception("Failed to obtain Google credentials")
-        
-    client = gspread.authorize(creds)
-    
-    # List all accessible spreadsheets
-    print("Accessible spreadsheets:")
+def _open_spreadsheet():
+    """Authorizes with Google and opens the configured spreadsheet, or returns None if that fails."""
     try:
-        all_sheets = client.openall()
-        for sheet in all_sheets:
-            print(f"  - {sheet.title} (ID: {sheet.id})")
-    except Exception as e:
-        print(f"Could not list spreadsheets: {e}")
-    
-    # Try to open existing sheet by ID (more reliable)
-    try:
-        print(f"Attempting to open sheet by ID: {GOOGLE_SHEET_ID}")
-        spreadsheet = client.open_by_key(GOOGLE_SHEET_ID)
-        print(f"SUCCESS: Connected to Google Sheet: {spreadsheet.title}")
+        creds = get_google_credentials()
+        if not creds:
+            raise Exception("Failed to obtain Google credentials")
+            
+        client = gspread.authorize(creds)
+        # Keep one kept-alive connection per worker thread instead of requests' default of 10
+        client.http_client.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=SHEETS_HTTP_POOL_SIZE))
+        # A pooled connection that was silently dropped would otherwise block its worker thread forever
+        client.set_timeout(SHEETS_HTTP_TIMEOUT)
+        
+        # Listing every spreadsheet the service account can see is slow, so only do it when debugging access
+        if os.getenv('DEBUG_SHEETS'):
+            logger.info("Accessible spreadsheets:")
+            try:
+                all_sheets = client.openall()
+                for sheet in all_sheets:
+                    logger.info("  - %s (ID: %s)", sheet.title, sheet.id)
+            except Exception as e:
+                logger.warning("Could not list spreadsheets: %s", e)
+        
+        # Try to open existing sheet by ID (more reliable)
+        try:
+            logger.info("Attempting to open sheet by ID: %s", GOOGLE_SHEET_ID)
+            spreadsheet = client.open_by_key(GOOGLE_SHEET_ID)
+            logger.info("Connected to Google Sheet: %s", spreadsheet.title)
+        except Exception as e:
+            logger.error(
+                "Could not open sheet by ID (%s: %s). Please ensure: 1. Sheet ID is correct: %s; "
+                "2. Sheet is shared with: bookcashierbot@bookfaircashierbot.iam.gserviceaccount.com; "
+                "3. Service account has 'Editor' permissions",
+                type(e).__name__, e, GOOGLE_SHEET_ID
+            )
+            return None
+        
+        logger.info("Spreadsheet ID: %s", spreadsheet.id)
+        # Keep the handles from this listing so the first reads don't look each worksheet up again
+        worksheets = spreadsheet.worksheets()
+        _worksheets.update((worksheet.title, worksheet) for worksheet in worksheets)
+        logger.info("Available worksheets: %s", [ws.title for ws in worksheets])
+        return spreadsheet
+        
     except Exception as e:
-        print(f"ERROR: Could not open sheet by ID: {e}")
-        print(f"Error type: {type(e)}")
-        print("Please ensure:")
-        print(f"  1. Sheet ID is correct: {GOOGLE_SHEET_ID}")
-        print(f"  2. Sheet is shared with: bookcashierbot@bookfaircashierbot.iam.gserviceaccount.com")
-        print(f"  3. Service account has 'Editor' permissions")
-        spreadsheet = None
-    
-    if spreadsheet:
-        print(f"Spreadsheet ID: {spreadsheet.id}")
-        print(f"Available worksheets: {[ws.title for ws in spreadsheet.worksheets()]}")
-    
-except Exception as e:
-    print(f"Error with Google Sheets: {e}")
-    print(f"Error type: {type(e)}")
-    spreadsheet = None
+        logger.error("Error with Google Sheets (%s): %s", type(e).__name__, e)
+        return None
+
+# Connecting happens on first use instead of at import; after a failure it is retried at most this often
+SPREADSHEET_RETRY_INTERVAL = 30  # seconds
+_spreadsheet_lock = threading.Lock()
+_spreadsheet_retry_at = 0.0
+_spreadsheet = None
+
+def get_spreadsheet():
+    """Returns the connected spreadsheet, connecting on first use; None while the connection is failing."""
+    global _spreadsheet, _spreadsheet_retry_at
+    if _spreadsheet is None and time.monotonic() >= _spreadsheet_retry_at:
+        with _spreadsheet_lock:
+            if _spreadsheet is None and time.monotonic() >= _spreadsheet_retry_at:
+                _spreadsheet = _open_spreadsheet()
+                if _spreadsheet is None:
+                    # e.g. the network was down at startup: don't stay offline until the next restart
+                    _spreadsheet_retry_at = time.monotonic() + SPREADSHEET_RETRY_INTERVAL
+    return _spreadsheet
 
 # --- Cache management ---
 def clear_all_caches():
     """Clears all caches to force fresh data retrieval"""
     global _cache, _all_products_cache, _all_products_cache_time
+    global _product_index, _product_index_source, _author_index, _author_index_source
+    global _products_by_type, _products_by_author, _lottery_products, _lottery_products_by_author, _product_groups_source
+    global _lottery_authors, _lottery_authors_source, _next_transaction_id
+    global _transactions_by_author, _transactions_by_author_source, _spreadsheet_retry_at
+    cached_entries = len(_cache)
     _cache.clear()
+    _worksheets.clear()
     _all_products_cache = None
     _all_products_cache_time = 0
-    print("All caches cleared")
+    _product_index, _product_index_source = {}, None
+    _author_index, _author_index_source = {}, None
+    _products_by_type, _products_by_author, _lottery_products, _product_groups_source = {}, {}, [], None
+    _lottery_products_by_author = {}
+    _lottery_authors, _lottery_authors_source = [], None
+    _transactions_by_author, _transactions_by_author_source = {}, None
+    _spreadsheet_retry_at = 0.0  # /refresh reconnects right away if Sheets was unreachable
+    with _transaction_id_lock:
+        _next_transaction_id = None
+    logger.info("All caches cleared (%d cached results dropped)", cached_entries)
+
+# Worksheet handles by title; gspread fetches sheet metadata each time one is looked up
+_worksheets = {}
+
+def get_worksheet(title):
+    """Returns the worksheet with the given title, looking it up only the first time."""
+    worksheet = _worksheets.get(title)
+    if worksheet is None:
+        worksheet = _worksheets[title] = get_spreadsheet().worksheet(title)
+    return worksheet
 
 # --- Batch operations ---
 _all_products_cache = None
 _all_products_cache_time = 0
+_all_products_lock = threading.Lock()
+
+def _to_number(value):
+    """Returns a numeric sheet cell as is; blank or non-numeric cells count as 0."""
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return 0
+    return int(number) if number.is_integer() else number
+
+def normalize_product(product):
+    """Cleans up a product row once at load time so lookups can compare raw values.
+
+    ProductType is stripped, Promotion and Lottery are stripped and lower-cased,
+    and Price and Discount are numbers.
+    """
+    product['ProductType'] = str(product.get('ProductType', '')).strip()
+    product['Promotion'] = str(product.get('Promotion', '')).strip().lower()
+    product['Lottery'] = str(product.get('Lottery', '')).strip().lower()
+    product['Price'] = _to_number(product.get('Price', 0))
+    product['Discount'] = _to_number(product.get('Discount', 0))
+    return product
 
 def get_all_products():
     """Get all products at once to reduce API calls"""
     global _all_products_cache, _all_products_cache_time
-    current_time = time.time()
-    
-    if _all_products_cache and current_time - _all_products_cache_time < 300:
+    if _all_products_cache and time.monotonic() - _all_products_cache_time < CACHE_TTL:
         return _all_products_cache
     
-    if not spreadsheet:
-        return []
-    try:
-        products_sheet = spreadsheet.worksheet("Products")
-        _all_products_cache = products_sheet.get_all_records()
-        _all_products_cache_time = current_time
-        return _all_products_cache
-    except Exception as e:
-        print(f"Error fetching all products: {e}")
+    if not get_spreadsheet():
         return []
+    # One refill at a time: callers arriving while it runs get its result instead of fetching again
+    with _all_products_lock:
+        current_time = time.monotonic()
+        if _all_products_cache and current_time - _all_products_cache_time < CACHE_TTL:
+            return _all_products_cache
+        try:
+            _all_products_cache = [normalize_product(product) for product in _get_records("Products")]
+            _all_products_cache_time = current_time
+            return _all_products_cache
+        except Exception as e:
+            logger.error("Error fetching all products: %s", e)
+            return []
 
 # --- Functions to interact with the sheet ---
 
-@with_cache(ttl=600)  # Cache for 10 minutes
+AUTHORS_CACHE_TTL = 600  # Cache for 10 minutes
+
+# Not connected, or the read failed: raised inside the cached function so no empty result gets cached
+SHEETS_OFFLINE_ERROR = "Google Sheets is not connected"
+
+@with_cache(ttl=AUTHORS_CACHE_TTL)
 @retry_with_backoff()
+def _fetch_authors():
+    """Reads all authors from the 'Authors' worksheet; raises if Sheets can't be reached."""
+    if not get_spreadsheet():
+        raise ConnectionError(SHEETS_OFFLINE_ERROR)
+    return _get_records("Authors")
+
 def get_authors():
     """Fetches all authors from the 'Authors' worksheet."""
-    if not spreadsheet:
-        return []
     try:
-        authors_sheet = spreadsheet.worksheet("Authors")
-        return authors_sheet.get_all_records()
+        return _fetch_authors()
     except Exception as e:
-        print(f"Error fetching authors: {e}")
+        logger.error("Error fetching authors: %s", e)
         return []
 
-def get_products_by_author(author_id):
-    """Fetches all products for a specific author using batch data."""
+# --- Lookup indexes ---
+# Built lazily from the cached lists and rebuilt whenever the underlying list is refreshed
+_product_index = {}
+_product_index_source = None
+_author_index = {}
+_author_index_source = None
+_products_by_type = {}
+_products_by_author = {}
+_lottery_products = []
+_lottery_products_by_author = {}
+_product_groups_source = None
+_lottery_authors = []
+_lottery_authors_source = None
+
+def get_product_index():
+    """Returns a {ProductID: product} dict built from the cached product list."""
+    global _product_index, _product_index_source
     all_products = get_all_products()
-    return [product for product in all_products if product.get('AuthorID') == author_id]
+    if all_products is not _product_index_source:
+        _product_index = {product.get('ProductID'): product for product in all_products}
+        _product_index_source = all_products
+    return _product_index
+
+BUTTON_TITLE_MAX_LENGTH = 30
+
+def _refresh_product_groups():
+    """Regroups the cached product list by ProductType and AuthorID if the list has been refreshed."""
+    global _products_by_type, _products_by_author, _lottery_products, _lottery_products_by_author, _product_groups_source
+    all_products = get_all_products()
+    if all_products is not _product_groups_source:
+        # Built in locals and published together, so a reader or a concurrent rebuild never sees half-filled groups
+        by_type, by_author, lottery, lottery_by_author = {}, {}, [], {}
+        for product in all_products:
+            # Button label, shortened once per refresh instead of on every page render
+            title = str(product.get('Title', 'Без названия'))
+            product['DisplayTitle'] = title if len(title) <= BUTTON_TITLE_MAX_LENGTH else title[:BUTTON_TITLE_MAX_LENGTH - 1].rstrip() + "…"
+            by_type.setdefault(product['ProductType'], []).append(product)
+            by_author.setdefault(product.get('AuthorID'), []).append(product)
+            if product['Lottery'] == 'yes':
+                lottery.append(product)
+                lottery_by_author.setdefault(product.get('AuthorID'), []).append(product)
+        _products_by_type, _products_by_author, _lottery_products, _lottery_products_by_author = by_type, by_author, lottery, lottery_by_author
+        _product_groups_source = all_products
+
+def get_products_by_type(product_type):
+    """Fetches all products of the given ProductType using an index built from the cached product list."""
+    _refresh_product_groups()
+    return _products_by_type.get(product_type, [])
+
+def get_products_by_author(author_id):
+    """Fetches all products for a specific author using an index built from the cached product list."""
+    _refresh_product_groups()
+    return _products_by_author.get(author_id, [])
 
 def get_lottery_products():
     """Fetches all products eligible for lottery (where Lottery = Yes)."""
-    all_products = get_all_products()
-    return [product for product in all_products if product.get('Lottery', '').strip().lower() == 'yes']
+    _refresh_product_groups()
+    return _lottery_products
+
+def get_lottery_products_by_author(author_id):
+    """Fetches the lottery-eligible products of a specific author from the grouped product cache."""
+    _refresh_product_groups()
+    return _lottery_products_by_author.get(author_id, [])
+
+def get_lottery_authors():
+    """Returns the authors that have lottery-eligible products, in author sheet order."""
+    global _lottery_authors, _lottery_authors_source
+    authors = get_authors()
+    _refresh_product_groups()
+    # Rebuilt only when either the author list or the product groups have been refreshed
+    source = _lottery_authors_source
+    if source is None or source[0] is not authors or source[1] is not _lottery_products_by_author:
+        _lottery_authors = [author for author in authors if author.get('AuthorID') in _lottery_products_by_author]
+        _lottery_authors_source = (authors, _lottery_products_by_author)
+    return _lottery_authors
+
+def get_author_index():
+    """Returns an {AuthorID: author} dict built from the cached author list."""
+    global _author_index, _author_index_source
+    authors = get_authors()
+    if authors is not _author_index_source:
+        _author_index = {author.get('AuthorID'): author for author in authors}
+        _author_index_source = authors
+    return _author_index
+
+def get_product_by_id(product_id):
+    """Fetches a single product by its ProductID, or None if it doesn't exist."""
+    return get_product_index().get(product_id)
+
+def get_author_by_id(author_id):
+    """Fetches a single author by their AuthorID, or None if they don't exist."""
+    return get_author_index().get(author_id)
+
+def warm_product_caches():
+    """Loads the product list and builds the product lookup indexes."""
+    get_product_index()
+    _refresh_product_groups()
+
+def warm_author_caches():
+    """Loads the author list and builds the author lookup index."""
+    get_author_index()
+
+def _records_from_values(values):
+    """Turns a block of sheet values, header row first, into rows like Worksheet.get_all_records() returns."""
+    values = gspread.utils.fill_gaps(values)
+    if len(values) < 2:
+        return []
+    header, rows = values[0], values[1:]
+    return gspread.utils.to_records(header, [gspread.utils.numericise_all(row) for row in rows])
+
+def _get_records(range_name):
+    """Reads a worksheet or A1 range with a single values_get call and returns its rows as dicts."""
+    response = get_spreadsheet().values_get(range_name)
+    return _records_from_values(response.get('values', []))
 
 @retry_with_backoff()
+def _load_sheet_caches(include_transactions=True):
+    """Fills the product, author and (optionally) transaction caches from a single batched read."""
+    global _all_products_cache, _all_products_cache_time
+    transactions_version = _transactions_version
+    ranges = ["Products", "Authors", TRANSACTIONS_RANGE] if include_transactions else ["Products", "Authors"]
+    response = get_spreadsheet().values_batch_get(ranges)
+    products_values, authors_values, *transactions_values = (
+        value_range.get('values', []) for value_range in response['valueRanges']
+    )
+    products = [normalize_product(product) for product in _records_from_values(products_values)]
+    # Same lock as get_all_products, so the list and its load time always come from the same read
+    with _all_products_lock:
+        _all_products_cache, _all_products_cache_time = products, time.monotonic()
+    prime_cache(_fetch_authors.__name__, _records_from_values(authors_values), AUTHORS_CACHE_TTL)
+    if not include_transactions:
+        return
+    transactions = _normalize_transactions(_records_from_values(transactions_values[0]))
+    # Checked under the refill lock, which a recorded sale takes before adding its rows to the cache
+    with refill_lock(_fetch_transactions.__name__):
+        # A sale recorded while the batch was in flight makes this copy stale: leave the cache to the next read
+        if transactions_version == _transactions_version:
+            prime_cache(_fetch_transactions.__name__, transactions, TRANSACTIONS_CACHE_TTL)
+
+def warm_caches():
+    """Loads products, authors, transactions and the lookup indexes so the first user request is served from cache."""
+    # Cold start or after clear_all_caches: fetch all three sheets in one API call instead of three
+    if _all_products_cache is None and get_spreadsheet():
+        try:
+            _load_sheet_caches()
+        except Exception as e:
+            logger.error("Error batch-loading the sheets: %s", e)
+    warm_product_caches()
+    warm_author_caches()
+
+def reload_caches():
+    """Re-reads products and authors ahead of their TTLs and rebuilds the lookup indexes."""
+    # Transactions are left out: recorded sales are written through to their cache, and an idle bot
+    # shouldn't re-read the whole sales sheet every few minutes
+    _load_sheet_caches(include_transactions=False)
+    warm_product_caches()
+    warm_author_caches()
+
+# Bumped on every append so a batched read started before the write doesn't overwrite fresher data
+_transactions_version = 0
+
+# Next TransactionID to hand out; read from the sheet on the first write and after a reset
+_next_transaction_id = None
+_transaction_id_lock = threading.Lock()
+
+def _reserve_transaction_ids(transactions_sheet, count):
+    """Returns the first of `count` consecutive TransactionIDs, reading the sheet only to seed the counter."""
+    global _next_transaction_id
+    with _transaction_id_lock:
+        if _next_transaction_id is None:
+            # Only the ID column is fetched; its header cell takes the place of the +1
+            _next_transaction_id = len(transactions_sheet.col_values(1))
+        first_id = _next_transaction_id
+        _next_transaction_id += count
+        return first_id
+
+def _reset_transaction_ids():
+    """Makes the next write re-read the ID column, e.g. after a failed append."""
+    global _next_transaction_id
+    with _transaction_id_lock:
+        _next_transaction_id = None
+
 def record_transaction(product_id, author_id, payment_method, amount):
     """Adds a new row to the 'Transactions' worksheet."""
-    if not spreadsheet:
-        return False
+    return record_transactions_batch([(product_id, author_id, payment_method, amount)]) == 1
+
+@retry_with_backoff(retryable=WRITE_RETRYABLE_STATUS_CODES)
+def _append_transaction_rows(transactions):
+    """Numbers the transactions and appends them in one API call; errors propagate so rate limits are retried."""
+    global _transactions_version
+    transactions_sheet = get_worksheet("Transactions")
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    first_id = _reserve_transaction_ids(transactions_sheet, len(transactions))
+
+    rows = [
+        [first_id + i, product_id, author_id, payment_method, amount, timestamp]
+        for i, (product_id, author_id, payment_method, amount) in enumerate(transactions)
+    ]
     try:
-        from datetime import datetime
-        transactions_sheet = spreadsheet.worksheet("Transactions")
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        # Generate transaction ID (could be improved with proper ID generation)
-        existing_transactions = transactions_sheet.get_all_records()
-        transaction_id = len(existing_transactions) + 1
-        
-        transactions_sheet.append_row([transaction_id, product_id, author_id, payment_method, amount, timestamp])
-        return True
+        response = transactions_sheet.append_rows(rows)
+    except Exception:
+        # The rows may or may not have landed: take the next IDs from the sheet again
+        _reset_transaction_ids()
+        raise
+    finally:
+        _transactions_version += 1
+    written = response.get('updates', {}).get('updatedRows', len(rows))
+    if written == len(rows):
+        _extend_cached_transactions(rows)
+    else:
+        # Which rows landed is unknown: re-read the sheet for both the cache and the next IDs
+        invalidate_cache(_fetch_transactions.__name__)
+        _reset_transaction_ids()
+    return written
+
+def _extend_cached_transactions(rows):
+    """Adds just-written rows to the cached transaction list, so the next report doesn't re-read the whole sheet."""
+    cache_key = (_fetch_transactions.__name__, (), ())
+    # A refill in flight holds this lock until it has stored its result, so waiting for it means the
+    # result can't overwrite these rows afterwards
+    with refill_lock(_fetch_transactions.__name__):
+        cached = _cache.get(cache_key)
+        if cached is None:
+            return
+        all_transactions, expires_at = cached
+        # A read that ran after the append landed already has these rows
+        known_ids = {transaction.get('TransactionID') for transaction in all_transactions}
+        new_rows = [row for row in rows if row[0] not in known_ids]
+        if not new_rows:
+            return
+        new_transactions = _normalize_transactions([dict(zip(TRANSACTION_COLUMNS, row)) for row in new_rows])
+        # A new list, not an in-place extend: the per-author index rebuilds when the list object changes.
+        # The expiry is kept so edits made directly in the sheet still show up within the TTL.
+        _cache[cache_key] = (all_transactions + new_transactions, expires_at)
+
+# Checkouts waiting for the next append; whoever holds _append_lock writes all of them in one call
+_pending_appends = []
+_pending_appends_lock = threading.Lock()
+_append_lock = threading.Lock()
+
+def _flush_pending_appends():
+    """Appends every queued checkout in one API call and records how many rows each one got (all or none)."""
+    with _pending_appends_lock:
+        batch = _pending_appends[:]
+        _pending_appends.clear()
+    if not batch:
+        return
+    rows = [transaction for pending in batch for transaction in pending['transactions']]
+    try:
+        written = _append_transaction_rows(rows)
     except Exception as e:
-        print(f"Error recording transaction: {e}")
-        return False
+        logger.error("Error recording transactions: %s", e)
+        written = 0
+    if written != len(rows):
+        # Sheets doesn't say which rows of a partial write landed, so no checkout counts as recorded
+        if written:
+            logger.error("Only %d of %d transaction rows were written; reporting the whole batch as failed", written, len(rows))
+        for pending in batch:
+            pending['written'] = 0
+        return
+    for pending in batch:
+        pending['written'] = len(pending['transactions'])
 
+def record_transactions_batch(transactions):
+    """Adds several rows to the 'Transactions' worksheet in a single API call.
+
+    Each item of `transactions` is a (product_id, author_id, payment_method, amount) tuple.
+    Returns the number of rows Google Sheets reports as written.
+    """
+    if not transactions or not get_spreadsheet():
+        return 0
+    pending = {'transactions': transactions, 'written': None}
+    with _pending_appends_lock:
+        _pending_appends.append(pending)
+    # Checkouts confirmed while another append is in flight are written together once it finishes
+    with _append_lock:
+        if pending['written'] is None:
+            _flush_pending_appends()
+    return pending['written']
+
+ISO_DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}$')
+
+# The columns _append_transaction_rows writes, in sheet order.
+# Values stay formatted so Timestamp comes back as the text that was written, not a date serial number.
+TRANSACTION_COLUMNS = ('TransactionID', 'ProductID', 'AuthorID', 'Payment_Method', 'Amount', 'Timestamp')
+TRANSACTIONS_RANGE = "Transactions!A:F"
+TRANSACTIONS_CACHE_TTL = 60  # Recorded sales are added to the cache; the TTL only catches edits made in the sheet
+
+def _parse_amount(value):
+    """Converts a sheet Amount cell to float; blank or malformed cells count as 0."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _normalize_transactions(transactions):
+    """Converts Amount to float and lower-cases Payment_Method in place; returns the same list."""
+    for transaction in transactions:
+        transaction['Amount'] = _parse_amount(transaction.get('Amount', 0))
+        transaction['Payment_Method'] = str(transaction.get('Payment_Method', '')).strip().lower()
+    return transactions
+
+@with_cache(ttl=TRANSACTIONS_CACHE_TTL)
 @retry_with_backoff()
-def get_transactions_from_date(start_date=None):
-    """Fetches transactions from a specific date onwards. If no date provided, gets all transactions."""
-    if not spreadsheet:
-        return []
+def _fetch_transactions():
+    """Reads every transaction, normalised; raises if Sheets can't be reached."""
+    if not get_spreadsheet():
+        raise ConnectionError(SHEETS_OFFLINE_ERROR)
+    return _normalize_transactions(_get_records(TRANSACTIONS_RANGE))
+
+def get_all_transactions():
+    """Fetches every transaction once, with Amount converted to float and Payment_Method lower-cased."""
     try:
-        transactions_sheet = spreadsheet.worksheet("Transactions")
-        all_transactions = transactions_sheet.get_all_records()
-        
-        if not start_date:
-            return all_transactions
-            
-        from datetime import datetime
-        # Filter transactions by date
-        filtered_transactions = []
-        for transaction in all_transactions:
-            transaction_date_str = transaction.get('Timestamp', '')
-            if transaction_date_str:
-                try:
-                    transaction_date = datetime.strptime(transaction_date_str.split(' ')[0], '%Y-%m-%d')
-                    start_date_obj = datetime.strptime(start_date, '%Y-%m-%d')
-                    if transaction_date >= start_date_obj:
-                        filtered_transactions.append(transaction)
-                except ValueError:
-                    continue
-        
-        return filtered_transactions
+        return _fetch_transactions()
     except Exception as e:
-        print(f"Error fetching transactions: {e}")
+        logger.error("Error fetching transactions: %s", e)
         return []
 
-def get_sales_summary_by_author(start_date=None):
-    """Gets sales summary grouped by author with cash/cashless breakdown."""
-    transactions = get_transactions_from_date(start_date)
-    authors = get_authors()
+def _filter_from_date(transactions, start_date):
+    """Keeps the transactions dated `start_date` or later, in their original order; all of them if no date."""
+    if not start_date:
+        return transactions
     
-    # Create author mapping
-    author_map = {author.get('AuthorID'): author.get('Name', 'Неизвестный автор') for author in authors}
+    if not ISO_DATE_RE.match(start_date):
+        return []
     
-    # Group by author
-    summary = {}
+    # Timestamps are written as 'YYYY-MM-DD HH:MM:SS', so the date prefix compares correctly as a string
+    filtered_transactions = []
     for transaction in transactions:
-        author_id = transaction.get('AuthorID')
-        payment_method = transaction.get('Payment_Method', '').lower()
-        amount = transaction.get('Amount', 0)
-        
-        if isinstance(amount, str):
-            try:
-                amount = float(amount)
-            except ValueError:
-                amount = 0
-        
-        author_name = author_map.get(author_id, f'Автор #{author_id}')
+        transaction_date = str(transaction.get('Timestamp', ''))[:10]
+        # The string comparison is cheap and rules out most rows; only those in range pay for the regex
+        if transaction_date >= start_date and ISO_DATE_RE.match(transaction_date):
+            filtered_transactions.append(transaction)
+    
+    return filtered_transactions
+
+def _newest_from_date(transactions, start_date):
+    """_filter_from_date for a newest-first list: stops at the first transaction dated before `start_date`."""
+    if not start_date:
+        return transactions
+    
+    if not ISO_DATE_RE.match(start_date):
+        return []
+    
+    filtered_transactions = []
+    for transaction in transactions:
+        transaction_date = str(transaction.get('Timestamp', ''))[:10]
+        if transaction_date >= start_date:
+            if ISO_DATE_RE.match(transaction_date):
+                filtered_transactions.append(transaction)
+        elif ISO_DATE_RE.match(transaction_date):
+            # Sorted newest first, so every dated transaction after this one is older still
+            break
+    
+    return filtered_transactions
+
+def get_transactions_from_date(start_date=None):
+    """Returns transactions from a specific date onwards. If no date provided, returns all transactions."""
+    return _filter_from_date(get_all_transactions(), start_date)
+
+# Per-author transactions, newest first, rebuilt only when the cached transaction list is replaced
+_transactions_by_author = {}
+_transactions_by_author_source = None
+
+def _timestamp_key(transaction):
+    """Sort key for transactions: 'YYYY-MM-DD HH:MM:SS' strings sort in chronological order."""
+    return str(transaction.get('Timestamp', ''))
+
+def get_transactions_by_author():
+    """Returns a {AuthorID: [transaction, ...]} dict built from the cached transaction list, newest first."""
+    global _transactions_by_author, _transactions_by_author_source
+    all_transactions = get_all_transactions()
+    if all_transactions is not _transactions_by_author_source:
+        transactions_by_author = {}
+        for transaction in all_transactions:
+            transactions_by_author.setdefault(transaction.get('AuthorID'), []).append(transaction)
+        for author_transactions in transactions_by_author.values():
+            author_transactions.sort(key=_timestamp_key, reverse=True)
+        _transactions_by_author = transactions_by_author
+        _transactions_by_author_source = all_transactions
+    return _transactions_by_author
+
+class AuthorSales(NamedTuple):
+    """One author's line in the sales summary."""
+    name: str
+    author_id: int
+    cash: float
+    cashless: float
+    total: float
+
+def get_sales_summary_by_author(start_date=None):
+    """Gets per-author sales with cash/cashless breakdown as AuthorSales rows, highest total first."""
+    author_index = get_author_index()
+    
+    # Transactions are already grouped by author, so each author's name is looked up once, not per sale
+    # Group by author: name -> [author_id, cash, cashless, total]
+    totals = {}
+    for author_id, author_transactions in get_transactions_by_author().items():
+        transactions = _newest_from_date(author_transactions, start_date)
+        if not transactions:
+            continue
         
-        if author_name not in summary:
-            summary[author_name] = {
-                'author_id': author_id,
-                'cash': 0,
-                'cashless': 0,
-                'total': 0,
-                'transactions': []
-            }
+        author = author_index.get(author_id)
+        author_name = author.get('Name', 'Неизвестный автор') if author else f'Автор #{author_id}'
         
-        summary[author_name]['transactions'].append(transaction)
-        summary[author_name]['total'] += amount
+        row = totals.get(author_name)
+        if row is None:
+            row = totals[author_name] = [author_id, 0, 0, 0]
         
-        if payment_method == 'cash':
-            summary[author_name]['cash'] += amount
-        elif payment_method == 'cashless':
-            summary[author_name]['cashless'] += amount
+        for transaction in transactions:
+            payment_method = transaction.get('Payment_Method', '')
+            amount = transaction.get('Amount', 0)
+            row[3] += amount
+            if payment_method == 'cash':
+                row[1] += amount
+            elif payment_method == 'cashless':
+                row[2] += amount
     
+    summary = [AuthorSales(author_name, *row) for author_name, row in totals.items()]
+    summary.sort(key=attrgetter('total'), reverse=True)
     return summary
 
-def get_author_transactions_detail(author_id, start_date=None):
-    """Gets detailed transaction list for a specific author."""
-    transactions = get_transactions_from_date(start_date)
-    all_products = get_all_products()
+class AuthorTransactionsDetail(NamedTuple):
+    """An author's sales for a period: the newest transactions plus totals over all of them."""
+    transactions: list
+    count: int
+    cash: float
+    cashless: float
+    total: float
+
+def get_author_transactions_detail(author_id, start_date=None, limit=None, offset=0):
+    """Gets totals and `limit` transactions (all if None), newest first after skipping `offset`, for a specific author.
+
+    Only the returned transactions are turned into detail dicts; the rest are just tallied.
+    """
+    # The per-author list is already newest first, so the date filter keeps that order and can stop early
+    matches = _newest_from_date(get_transactions_by_author().get(author_id, []), start_date)
+    
+    # Tally totals
+    cash = cashless = total = 0
+    for transaction in matches:
+        amount = transaction.get('Amount', 0)
+        total += amount
+        payment_method = transaction.get('Payment_Method', '')
+        if payment_method == 'cash':
+            cash += amount
+        elif payment_method == 'cashless':
+            cashless += amount
     
-    # Create product mapping
-    product_map = {product.get('ProductID'): product for product in all_products}
+    newest = matches[offset:] if limit is None else matches[offset:offset + limit]
     
-    # Filter by author
+    product_map = get_product_index()
     author_transactions = []
-    for transaction in transactions:
-        if transaction.get('AuthorID') == author_id:
-            product_id = transaction.get('ProductID')
-            product_info = product_map.get(product_id, {})
-            
-            transaction_detail = {
-                'timestamp': transaction.get('Timestamp', ''),
-                'product_title': product_info.get('Title', f'Продукт #{product_id}'),
-                'amount': transaction.get('Amount', 0),
-                'payment_method': transaction.get('Payment_Method', ''),
-                'transaction_id': transaction.get('TransactionID', '')
-            }
-            author_transactions.append(transaction_detail)
+    for transaction in newest:
+        product_id = transaction.get('ProductID')
+        product_info = product_map.get(product_id, {})
+        author_transactions.append({
+            'timestamp': transaction.get('Timestamp', ''),
+            'product_title': product_info.get('Title', f'Продукт #{product_id}'),
+            'amount': transaction.get('Amount', 0),
+            'payment_method': transaction.get('Payment_Method', ''),
+            'transaction_id': transaction.get('TransactionID', '')
+        })
     
-    # Sort by timestamp (newest first)
-    author_transactions.sort(key=lambda x: x['timestamp'], reverse=True)
-    return author_transactions
+    return AuthorTransactionsDetail(author_transactions, len(matches), cash, cashless, total)
 
 # setup_worksheets() has been moved to local_admin.py (local-only file)
@@ -1,11 +1,16 @@
 from telegram import Bot
-from config import TELEGRAM_TOKEN
+from dotenv import load_dotenv
 import asyncio
+import os
+
+load_dotenv()
+TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 
 async def test():
-    bot = Bot(TELEGRAM_TOKEN)
-    me = await bot.get_me()
-    print(f'Bot connected: {me.first_name} (@{me.username})')
+    # The context manager opens the bot's HTTP connection pool once and closes it on exit
+    async with Bot(TELEGRAM_TOKEN) as bot:
+        me = await bot.get_me()
+        print(f'Bot connected: {me.first_name} (@{me.username})')
 
 if __name__ == '__main__':
-    asyncio.run(test())
\ No newline at end of file
+    asyncio.run(test())